@@ -1,23 +1,39 @@
 import os
 import re
+import io
 import aiohttp
 import asyncio
 import threading
 from pathlib import Path
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
-from pyrogram import Client, filters
+from contextlib import asynccontextmanager, contextmanager, closing
+from pyrogram import Client, filters, idle
+from pyrogram.errors import FloodWait, MessageIdInvalid, MessageNotModified
 from pyrogram.types import Message, BotCommand, InlineKeyboardMarkup, InlineKeyboardButton
 from pyrogram.enums import ParseMode
 from PIL import Image
 from hachoir.parser import createParser
 from hachoir.metadata import extractMetadata
-import subprocess
 import traceback
 from flask import Flask, render_template_string
 import requests
 import time
 import math
+import csv
+import json
+import shutil
+import tarfile
+import zipfile
+import hashlib
+import sqlite3
+import socket
+import fcntl
+import contextvars
+import base64
 import logging
+import numpy as np
+import psutil
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -35,6 +51,8 @@ TMP.mkdir(parents=True, exist_ok=True)
 
 # state
 USER_THUMBS = {}
+# uid -> (thumb path, encoded JPEG bytes), least recently used first
+THUMB_CACHE = OrderedDict()
 TASKS = {}
 SET_THUMB_REQUEST = set()
 SUBSCRIBERS = set()
@@ -45,12 +63,121 @@ USER_COUNTERS = {}
 # New state for edit caption mode
 EDIT_CAPTION_MODE = set()
 USER_THUMB_TIME = {}
+# Users that get one source encoded to every [re (...)] quality in a single pass
+RENDITION_MODE = set()
+# Users that also get a contact sheet of the sampled preview frames
+CONTACT_SHEET_MODE = set()
+# uid -> (target bytes, x264 preset) for /target_size encodes
+USER_TARGET_SIZE = {}
+# client name -> transfers in flight / monotonic time it may be used again
+CLIENT_LOAD = {}
+# uid -> "off" | "flag" | "skip" | "reuse" (see /dupcheck)
+USER_DUP_MODE = {}
+# perceptual-hash index of uploaded videos, loaded lazily from PHASH_INDEX_PATH
+PHASH_INDEX = {"entries": None, "hashes": None, "durations": None}
+# uid -> chats/channels every finished upload is copied to
+USER_TARGETS = {}
+# job id -> job dict (see new_job)
+JOBS = {}
+# set around each submitted job (see dispatch_job): carries its caption slots, submission
+# number and queue id to the job created in that context, and receives that job back
+JOB_CONTEXT = contextvars.ContextVar("JOB_CONTEXT", default=None)
+# uid -> last submission number / submission number -> Event set once that job has finished
+SUBMIT_SEQ = {}
+OPEN_SUBMISSIONS = {}
+# uid -> reserved caption counter values that a failed, cancelled or skipped job never used;
+# they are taken back only once no higher value has been reserved
+FREE_CAPTION_SLOTS = {}
+# users whose deliveries to targets are committed in submission order
+ORDERED_DELIVERY = set()
+# finished job timelines, newest last (see record_job_trace)
+TRACE_HISTORY = deque(maxlen=int(os.getenv("TRACE_HISTORY", "200")))
+# last psutil reading, see current_rss
+MEMORY_SAMPLE = {"at": 0.0, "rss": 0}
+# downloaded file path -> sha256 hex computed while it was written
+FILE_DIGESTS = {}
+CLIENT_FLOOD_UNTIL = {}
 
 
 ADMIN_ID = int(os.getenv("ADMIN_ID", ""))
-MAX_SIZE = 4 * 1024 * 1024 * 1024
-
-app = Client("mybot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+# largest file the bot will download; anything above UPLOAD_LIMIT is split before upload
+MAX_SIZE = int(os.getenv("MAX_DOWNLOAD_SIZE", str(4 * 1024 * 1024 * 1024)))
+UPLOAD_LIMIT = int(os.getenv("UPLOAD_LIMIT", str(2000 * 1024 * 1024)))
+VIDEO_EXTS = {".mp4", ".mkv", ".avi", ".mov", ".flv", ".wmv", ".webm"}
+ARCHIVE_EXTS = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+DEFAULT_RENDITIONS = ["480p", "720p", "1080p"]
+RENDITION_PRESET = os.getenv("RENDITION_PRESET", "veryfast")
+# two-pass target-size encodes (/target_size)
+TARGET_PRESET = os.getenv("TARGET_PRESET", "medium")
+TARGET_AUDIO_KBPS = int(os.getenv("TARGET_AUDIO_KBPS", "128"))
+TARGET_MIN_VIDEO_KBPS = 150
+TARGET_SIZE_MARGIN = 0.97
+ENCODE_THREADS = int(os.getenv("ENCODE_THREADS", "0")) or os.cpu_count() or 1
+X264_PRESETS = ("ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow")
+THUMB_CACHE_SIZE = int(os.getenv("THUMB_CACHE_SIZE", "32"))
+PREVIEW_FRAMES = int(os.getenv("PREVIEW_FRAMES", "8"))
+PREVIEW_TIMEOUT = int(os.getenv("PREVIEW_TIMEOUT", "120"))
+# chat (usually a private channel) that the bot and every pool session can post in
+POOL_RELAY_CHAT = int(os.getenv("POOL_RELAY_CHAT", "0"))
+# parallel Telegram downloads; Pyrogram also caps transfers per client
+MAX_TRANSMISSIONS = int(os.getenv("MAX_TRANSMISSIONS", "8"))
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "4"))
+DOWNLOAD_PART_CHUNKS = int(os.getenv("DOWNLOAD_PART_CHUNKS", "16"))
+DOWNLOAD_PART_RETRIES = 3
+FAST_DOWNLOAD_MIN = 20 * 1024 * 1024
+# bandwidth caps in bytes/s (0 = unlimited), adjustable at runtime with /bwlimit
+BW_LIMITS = {
+    "down": float(os.getenv("BW_DOWN_MBPS", "0")) * 1024 * 1024,
+    "up": float(os.getenv("BW_UP_MBPS", "0")) * 1024 * 1024,
+    "job": float(os.getenv("BW_JOB_MBPS", "0")) * 1024 * 1024,
+    "small_share": float(os.getenv("BW_SMALL_SHARE", "0.3")),
+}
+SMALL_JOB_SIZE = int(os.getenv("SMALL_JOB_SIZE", str(200 * 1024 * 1024)))
+DELIVERY_CONCURRENCY = int(os.getenv("DELIVERY_CONCURRENCY", "3"))
+# optional JSON-lines file every finished job trace is appended to
+STATS_JSONL = os.getenv("STATS_JSONL")
+STATS_RECENT = 10
+# minimum seconds between two edits of a job's status message
+STATUS_MIN_INTERVAL = float(os.getenv("STATUS_MIN_INTERVAL", "3"))
+# persistent data that must survive the 3-day TMP cleanup
+DATA_DIR = Path(os.getenv("DATA_DIR", "data"))
+DATA_DIR.mkdir(parents=True, exist_ok=True)
+PHASH_INDEX_PATH = DATA_DIR / "phash_index.json"
+# mean Hamming distance (of 64 bits) per sampled frame that still counts as the same video
+PHASH_THRESHOLD = float(os.getenv("PHASH_THRESHOLD", "10"))
+DUPCHECK_DEFAULT = os.getenv("DUPCHECK_DEFAULT", "off")
+# "all" = one process does everything; "front" only runs handlers and queues jobs; "worker" runs queued jobs
+ROLE = os.getenv("ROLE", "all").lower()
+if ROLE not in ("all", "front", "worker"):
+    raise SystemExit(f"ROLE must be all, front or worker, not {ROLE!r}")
+# also names the worker's session file, so it must stay the same across restarts;
+# several workers on one host each need their own WORKER_ID
+WORKER_ID = os.getenv("WORKER_ID") or socket.gethostname()
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "2"))
+# a worker that misses heartbeats for this long is presumed dead and its job is handed out again
+QUEUE_LEASE = int(os.getenv("QUEUE_LEASE", "90"))
+QUEUE_POLL_INTERVAL = float(os.getenv("QUEUE_POLL_INTERVAL", "2"))
+QUEUE_MAX_ATTEMPTS = int(os.getenv("QUEUE_MAX_ATTEMPTS", "3"))
+# longest an ordered delivery waits for the jobs submitted before it
+ORDER_WAIT_MAX = int(os.getenv("ORDER_WAIT_MAX", "3600"))
+# RSS ceiling for the bot and its ffmpeg children; new stages pause above MEMORY_PAUSE_AT of it
+MEMORY_LIMIT = int(os.getenv("MEMORY_LIMIT_MB", "450")) * 1024 * 1024
+MEMORY_PAUSE_AT = float(os.getenv("MEMORY_PAUSE_AT", "0.9"))
+MEMORY_MAX_WAIT = 300
+# Pyrogram keeps about one queued plus four in-flight 512 KiB parts per upload
+UPLOAD_BUFFER_ESTIMATE = 5 * 512 * 1024
+
+if ROLE == "worker":
+    # two processes on one session file would fight over it; refuse to start instead
+    WORKER_LOCK = open(f"worker_{WORKER_ID}.lock", "w")
+    try:
+        fcntl.flock(WORKER_LOCK, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        raise SystemExit(f"Another worker on this host already runs as {WORKER_ID!r}; set a distinct WORKER_ID for each worker.")
+    # same bot, own session file, and no updates: the front process answers users
+    app = Client(f"worker_{WORKER_ID}", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN, no_updates=True, max_concurrent_transmissions=MAX_TRANSMISSIONS)
+else:
+    app = Client("mybot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN, max_concurrent_transmissions=MAX_TRANSMISSIONS)
 flask_app = Flask(__name__)
 
 # ---- utilities ----
@@ -99,12 +226,814 @@ def parse_time(time_str: str) -> int:
             total_seconds += int(part[:-1]) * 3600
     return total_seconds
 
+def human_size(num: int) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if num < 1024 or unit == "GB":
+            return f"{num:.0f}{unit}" if unit == "B" else f"{num:.1f}{unit}"
+        num /= 1024
+
+def oversize_error(resp):
+    """Rejects a response from its Content-Length before any byte is downloaded."""
+    try:
+        size = int(resp.headers.get("Content-Length", 0))
+    except (TypeError, ValueError):
+        return None
+    if size > MAX_SIZE:
+        return f"ফাইলের সাইজ ({human_size(size)}) {human_size(MAX_SIZE)} এর বেশি হতে পারে না।"
+    return None
+
 def progress_keyboard():
     return InlineKeyboardMarkup([[InlineKeyboardButton("Cancel ❌", callback_data="cancel_task")]])
 
 def delete_caption_keyboard():
     return InlineKeyboardMarkup([[InlineKeyboardButton("Delete Caption 🗑️", callback_data="delete_caption")]])
 
+def delete_targets_keyboard():
+    return InlineKeyboardMarkup([[InlineKeyboardButton("Delete Targets 🗑️", callback_data="delete_targets")]])
+
+# ---- memory governor ----
+def current_rss() -> int:
+    """RSS of the bot plus its ffmpeg children, cached briefly since psutil walks /proc."""
+    now = time.monotonic()
+    if now - MEMORY_SAMPLE["at"] < 0.5:
+        return MEMORY_SAMPLE["rss"]
+    proc = psutil.Process()
+    rss = proc.memory_info().rss
+    for child in proc.children(recursive=True):
+        try:
+            rss += child.memory_info().rss
+        except psutil.Error:
+            pass
+    MEMORY_SAMPLE.update(at=now, rss=rss)
+    return rss
+
+def memory_pressure() -> float:
+    return current_rss() / MEMORY_LIMIT if MEMORY_LIMIT > 0 else 0.0
+
+def adaptive_chunk_size(default: int = 1024 * 1024) -> int:
+    """Shrinks transfer buffers as RSS approaches the ceiling."""
+    pressure = memory_pressure()
+    if pressure < 0.6:
+        return default
+    if pressure < 0.75:
+        return min(default, 256 * 1024)
+    return min(default, 64 * 1024)
+
+def account_buffer(job: dict, delta: int):
+    if job is None:
+        return
+    job["buffered"] += delta
+    job["buffer_peak"] = max(job["buffer_peak"], job["buffered"])
+
+@contextmanager
+def reserve_buffer(job: dict, nbytes: int):
+    account_buffer(job, nbytes)
+    try:
+        yield
+    finally:
+        account_buffer(job, -nbytes)
+
+def is_oldest_job(job: dict) -> bool:
+    if not JOBS:
+        return True
+    return job is not None and job is min(JOBS.values(), key=lambda j: j["started"])
+
+async def wait_for_memory(job: dict, stage: str):
+    """Holds back the start of a new stage while memory is near the ceiling.
+
+    The oldest running job never waits, so there is always one job making
+    progress and releasing memory instead of every job waiting on the others.
+    """
+    waited = 0.0
+    while memory_pressure() >= MEMORY_PAUSE_AT and not is_oldest_job(job):
+        if job is not None and job["cancel"].is_set():
+            return
+        if waited == 0:
+            logger.info("Memory at %s of %s, holding %s", human_size(current_rss()), human_size(MEMORY_LIMIT), stage)
+        await asyncio.sleep(1)
+        waited += 1
+        if waited >= MEMORY_MAX_WAIT:
+            logger.warning("Starting %s after waiting %ss for memory", stage, int(waited))
+            break
+    if job is not None and waited:
+        job["memory_wait"] = job.get("memory_wait", 0) + waited
+
+# ---- jobs & bandwidth shaping ----
+class TokenBucket:
+    """Byte-rate limiter; a rate of 0 means unlimited. Callers may overdraw
+    and then sleep off the debt, so chunks larger than one second's worth
+    still pass."""
+
+    def __init__(self, rate: float = 0):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def set_rate(self, rate: float):
+        self.rate = rate
+        self.tokens = min(self.tokens, rate)
+
+    async def consume(self, nbytes: int):
+        if self.rate <= 0 or nbytes <= 0:
+            return
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= nbytes
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+LANE_BUCKETS = {lane: {"down": TokenBucket(), "up": TokenBucket()} for lane in ("small", "bulk")}
+
+def new_job(uid: int, kind: str, size: int = 0, cancel_event: asyncio.Event = None) -> dict:
+    job = {
+        "id": f"{uid}-{time.time_ns()}",
+        "uid": uid,
+        "kind": kind,
+        "cancel": cancel_event or asyncio.Event(),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "started": time.monotonic(),
+        "spans": [],
+        # bytes this job holds in transfer buffers right now / at most
+        "buffered": 0,
+        "buffer_peak": 0,
+        # per-job delivery override (None = the user's saved targets)
+        "targets": None,
+        # (uploaded message, caption) pairs, in upload order
+        "sent": [],
+        "size": size,
+        "lane": "bulk",
+        "down": TokenBucket(BW_LIMITS["job"]),
+        "up": TokenBucket(BW_LIMITS["job"]),
+    }
+    JOBS[job["id"]] = job
+    ctx = JOB_CONTEXT.get()
+    if ctx is not None and "job" not in ctx:
+        ctx["job"] = job
+        # caption counter values reserved for this job when it was submitted
+        job["caption_slots"] = list(ctx.get("caption_slots", ()))
+        job["seq"] = ctx.get("seq")
+        job["queue_id"] = ctx.get("queue_id")
+        job["status_message_id"] = ctx.get("status_message_id")
+        job["settings"] = ctx.get("settings")
+    set_job_size(job, size)
+    return job
+
+def set_job_size(job: dict, size: int):
+    """Puts small files in the priority lane."""
+    if job is None:
+        return
+    job["size"] = size
+    job["lane"] = "small" if 0 < size <= SMALL_JOB_SIZE else "bulk"
+    rebalance_lanes()
+
+def finish_job(job: dict):
+    if job is not None:
+        JOBS.pop(job["id"], None)
+        rebalance_lanes()
+        record_job_trace(job)
+        if "cancelled_at" in job:
+            logger.info("Job %s released its resources %.2fs after cancel", job["id"], time.monotonic() - job["cancelled_at"])
+
+def rebalance_lanes():
+    """Splits the global caps between lanes; the small lane keeps its reserved
+    share while bulk jobs run, and either lane gets everything when alone."""
+    active = {j["lane"] for j in JOBS.values()}
+    share = BW_LIMITS["small_share"]
+    for direction in ("down", "up"):
+        total = BW_LIMITS[direction]
+        small, bulk = LANE_BUCKETS["small"][direction], LANE_BUCKETS["bulk"][direction]
+        if total <= 0 or len(active) < 2:
+            small.set_rate(total)
+            bulk.set_rate(total)
+        else:
+            small.set_rate(total * share)
+            bulk.set_rate(total * (1 - share))
+
+rebalance_lanes()
+# copy_message calls per second across all deliveries
+DELIVERY_RATE = TokenBucket(float(os.getenv("DELIVERY_RATE", "10")))
+
+async def throttle(job: dict, direction: str, nbytes: int):
+    if job is None:
+        await LANE_BUCKETS["bulk"][direction].consume(nbytes)
+        return
+    await job[direction].consume(nbytes)
+    await LANE_BUCKETS[job["lane"]][direction].consume(nbytes)
+
+def on_cancel(cancel_event: asyncio.Event, callback):
+    """Calls `callback` the moment the event is set; cancel the returned task once the guarded work is done."""
+    if cancel_event is None:
+        return None
+    async def watch():
+        await cancel_event.wait()
+        callback()
+    return asyncio.create_task(watch())
+
+async def upload_progress(current, total, job, state, cancel_event):
+    """Pyrogram progress hook that paces the upload through the job's buckets."""
+    if cancel_event and cancel_event.is_set():
+        # makes send_video/send_document abort and return None
+        app.stop_transmission()
+    # a retried upload starts again from zero
+    delta = current - state["sent"] if current >= state["sent"] else current
+    state["sent"] = current
+    await throttle(job, "up", delta)
+
+async def download_progress(current, total, job, state, cancel_event):
+    """Pyrogram progress hook for single-stream downloads; paces them like upload_progress."""
+    if cancel_event and cancel_event.is_set():
+        app.stop_transmission()
+    delta = current - state["got"] if current >= state["got"] else current
+    state["got"] = current
+    await throttle(job, "down", delta)
+
+# ---- job timing trace ----
+@contextmanager
+def trace_span(job: dict, stage: str, nbytes: int = 0):
+    """Records how long a pipeline stage took (and how many bytes it moved) on the job's timeline."""
+    started = time.monotonic()
+    span = {"stage": stage, "start": 0.0, "duration": 0.0, "bytes": nbytes}
+    if job is not None:
+        job["stage"] = stage
+    try:
+        yield span
+    finally:
+        if job is not None:
+            span["start"] = round(started - job["started"], 3)
+            span["duration"] = round(time.monotonic() - started, 3)
+            job["spans"].append(span)
+
+def record_job_trace(job: dict):
+    if job.get("cancelled_at") or job["cancel"].is_set():
+        status = "cancelled"
+    else:
+        status = "failed" if job.get("error") else "ok"
+    trace = {
+        "id": job["id"],
+        "uid": job["uid"],
+        "kind": job["kind"],
+        "created": job["created"],
+        "status": status,
+        "error": job.get("error"),
+        "total": round(time.monotonic() - job["started"], 3),
+        "size": job["size"],
+        "buffer_peak": job["buffer_peak"],
+        "memory_wait": job.get("memory_wait", 0),
+        "api_calls": job.get("api_calls"),
+        "spans": job["spans"],
+    }
+    TRACE_HISTORY.append(trace)
+    if STATS_JSONL:
+        try:
+            with open(STATS_JSONL, "a", encoding="utf-8") as f:
+                f.write(json.dumps(trace, ensure_ascii=False) + "\n")
+        except Exception as e:
+            logger.warning("Stats export failed: %s", e)
+
+def stage_percentiles() -> dict:
+    """stage -> (count, p50, p90, p99) seconds over the trace ring buffer."""
+    durations = {}
+    for trace in TRACE_HISTORY:
+        for span in trace["spans"]:
+            durations.setdefault(span["stage"], []).append(span["duration"])
+    stats = {}
+    for stage, values in durations.items():
+        p50, p90, p99 = np.percentile(np.array(values), [50, 90, 99])
+        stats[stage] = (len(values), p50, p90, p99)
+    return stats
+
+def format_job_trace(trace: dict) -> str:
+    parts = []
+    for span in trace["spans"]:
+        text = f"{span['stage']} {span['duration']:.1f}s"
+        if span["bytes"] and span["duration"] > 0:
+            text += f" ({human_size(span['bytes'])}, {human_size(span['bytes'] / span['duration'])}/s)"
+        if span.get("speed"):
+            text += f" {span['speed']}x realtime"
+        parts.append(text)
+    if trace.get("memory_wait"):
+        parts.append(f"memory wait {trace['memory_wait']:.0f}s")
+    if trace.get("api_calls"):
+        parts.append(format_api_calls(trace["api_calls"]))
+    return f"{trace['kind']} [{trace['status']}] {trace['total']:.1f}s, buf {human_size(trace.get('buffer_peak', 0))}: " + (" | ".join(parts) or "-")
+
+# ---- job status message ----
+class StatusMessage:
+    """The single status message of a job.
+
+    Updates are coalesced: an edit within STATUS_MIN_INTERVAL of the previous one is
+    deferred and overwritten by any newer text, unchanged text is never sent, and a
+    failed edit is logged rather than answered with a new message. Every Telegram
+    call is counted in job["api_calls"].
+    """
+
+    def __init__(self, c: Client, m: Message, job: dict):
+        self.c = c
+        self.chat_id = m.chat.id
+        self.m = m
+        # a front process may already have posted the message this job reports in
+        self.msg_id = job.get("status_message_id")
+        self.shown = None
+        self.pending = None
+        self.last_edit = 0.0
+        self.flush_task = None
+        self.closed = False
+        # set by finish(text): the message closes once that text is on screen
+        self.final = False
+        self.lock = asyncio.Lock()
+        job["api_calls"] = {"send": 0, "edit": 0, "delete": 0, "coalesced": 0}
+        job["status"] = self
+        self.job = job
+
+    def _count(self, kind: str):
+        self.job["api_calls"][kind] += 1
+
+    async def update(self, text: str, cancellable: bool = True):
+        if self.closed or self.final:
+            return
+        if self.pending is not None:
+            self._count("coalesced")
+        self.pending = (text, cancellable)
+        wait = self.last_edit + STATUS_MIN_INTERVAL - time.monotonic()
+        if self.msg_id is None or wait <= 0:
+            await self._flush()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_later(wait))
+
+    async def _flush_later(self, delay: float):
+        await asyncio.sleep(delay)
+        self.flush_task = None
+        await self._flush()
+
+    async def _flush(self):
+        async with self.lock:
+            state, self.pending = self.pending, None
+            if state is None or self.closed:
+                return
+            if state == self.shown:
+                self._count("coalesced")
+                self.closed = self.final
+                return
+            text, cancellable = state
+            markup = progress_keyboard() if cancellable else None
+            try:
+                if self.msg_id is None:
+                    self._count("send")
+                    self.msg_id = (await self.m.reply_text(text, reply_markup=markup)).id
+                else:
+                    self._count("edit")
+                    await self.c.edit_message_text(self.chat_id, self.msg_id, text, reply_markup=markup)
+                self.shown = state
+            except MessageNotModified:
+                self.shown = state
+            except MessageIdInvalid:
+                # the message is gone (e.g. the front deleted it on Cancel); stop editing it
+                self.closed = True
+                return
+            except FloodWait as e:
+                # keep the newest text and retry once the wait is over
+                if self.pending is None:
+                    self.pending = state
+                if self.flush_task is None and not self.closed:
+                    self.flush_task = asyncio.create_task(self._flush_later(e.value))
+                return
+            except Exception as e:
+                logger.warning("Status update failed: %s", e)
+            self.last_edit = time.monotonic()
+            if self.final:
+                self.closed = True
+
+    async def finish(self, text: str = None):
+        """Leaves `text` as the final state without a Cancel button, or deletes the message.
+
+        Only the first call has an effect. If the final edit hits a FloodWait the
+        message stays open until the retry has shown the text.
+        """
+        if self.closed or self.final:
+            return
+        if self.flush_task:
+            self.flush_task.cancel()
+            self.flush_task = None
+        if text is not None:
+            self.final = True
+            self.pending = (text, False)
+            await self._flush()
+            return
+        self.closed = True
+        self.pending = None
+        if self.msg_id is not None:
+            self._count("delete")
+            try:
+                await self.c.delete_messages(self.chat_id, self.msg_id)
+            except Exception:
+                pass
+
+def format_api_calls(calls: dict) -> str:
+    if not calls:
+        return ""
+    total = calls["send"] + calls["edit"] + calls["delete"]
+    return f"api {total} (send {calls['send']}, edit {calls['edit']}, delete {calls['delete']}, coalesced {calls['coalesced']})"
+
+# ---- delivery targets ----
+def parse_targets(text: str) -> list:
+    """Parses '@chan1, -100123 @chan2' into chat ids/usernames."""
+    targets = []
+    for token in re.split(r"[,\s]+", text.strip()):
+        if not token:
+            continue
+        targets.append(int(token) if token.lstrip("-").isdigit() else token)
+    return targets
+
+def split_targets_arg(text: str):
+    """Splits a trailing '--to <chats>' off a command argument. Returns (rest, targets or None)."""
+    # only a standalone token counts, so URLs and file names containing "--to" stay intact
+    parts = re.split(r"\s--to(?:\s|$)", text, maxsplit=1)
+    if len(parts) == 1:
+        return text, None
+    return parts[0].strip(), parse_targets(parts[1])
+
+def caption_for_chat(caption: str, chat_title: str) -> str:
+    return caption.replace("[chat]", chat_title) if caption else caption
+
+async def deliver_to_targets(c: Client, sent_items: list, targets: list):
+    """Copies already uploaded messages to every target; no file bytes move.
+
+    Returns (delivered, failed) counts.
+    """
+    titles = {}
+    delivered, failed = 0, 0
+    semaphore = asyncio.Semaphore(DELIVERY_CONCURRENCY)
+
+    async def deliver(target, sent, caption):
+        nonlocal delivered, failed
+        async with semaphore:
+            for attempt in range(2):
+                await DELIVERY_RATE.consume(1)
+                try:
+                    if caption and "[chat]" in caption:
+                        if target not in titles:
+                            chat = await c.get_chat(target)
+                            titles[target] = chat.title or chat.username or str(target)
+                        await c.copy_message(target, sent.chat.id, sent.id, caption=caption_for_chat(caption, titles[target]), parse_mode=ParseMode.MARKDOWN)
+                    else:
+                        await c.copy_message(target, sent.chat.id, sent.id)
+                    delivered += 1
+                    return
+                except FloodWait as e:
+                    await asyncio.sleep(e.value)
+                except Exception as e:
+                    logger.warning("Delivery to %s failed: %s", target, e)
+                    break
+            failed += 1
+
+    # messages go out in upload order; targets for one message run concurrently
+    for sent, caption in sent_items:
+        await asyncio.gather(*(deliver(target, sent, caption) for target in targets))
+    return delivered, failed
+
+# ---- caption sequencer ----
+def caption_slot_count(uid: int) -> int:
+    """How many captions a job will render: one per [re (...)] label in rendition mode, else one."""
+    if uid in RENDITION_MODE:
+        return len(rendition_labels(USER_CAPTIONS.get(uid)))
+    return 1
+
+def reserve_caption_slots(uid: int, count: int) -> list:
+    """Returns the counter values the job will caption with."""
+    if not USER_CAPTIONS.get(uid):
+        return []
+    counters = USER_COUNTERS.setdefault(uid, {'uploads': 0, 'episode_numbers': {}})
+    start = counters['uploads'] + 1
+    counters['uploads'] += count
+    return list(range(start, counters['uploads'] + 1))
+
+def release_caption_slots(uid: int, slots: list):
+    """Takes back values a job reserved but never captioned with.
+
+    The counter only rolls back over values at its top, so the next file is never
+    numbered below one that was already posted. A value freed while a later job
+    still holds a higher one stays a gap in the numbering.
+    """
+    counters = USER_COUNTERS.get(uid)
+    if not slots or not counters:
+        return
+    # values from before a caption reset belong to the old numbering
+    free = FREE_CAPTION_SLOTS.setdefault(uid, set())
+    free.update(v for v in slots if v <= counters['uploads'])
+    while counters['uploads'] in free:
+        free.discard(counters['uploads'])
+        counters['uploads'] -= 1
+
+def next_caption_slot(job: dict):
+    # None falls back to the live counter (e.g. the extra members of an archive)
+    if job and job.get("caption_slots"):
+        return job["caption_slots"].pop(0)
+    return None
+
+def job_caption(uid: int, template: str, job: dict, plain: str) -> str:
+    """Renders the caption of a job's next upload, or `plain` without a template.
+
+    A queued job only owns the numbers the front reserved for it; a further upload
+    (e.g. another archive member) gets `plain`, since any number the worker
+    counted on its own could already belong to another job.
+    """
+    if not template:
+        return plain
+    if job and job.get("queue_id") is not None and not job.get("caption_slots"):
+        return plain
+    return process_dynamic_caption(uid, template, next_caption_slot(job))
+
+def open_submission(uid: int) -> int:
+    seq = SUBMIT_SEQ.get(uid, 0) + 1
+    SUBMIT_SEQ[uid] = seq
+    OPEN_SUBMISSIONS.setdefault(uid, {})[seq] = asyncio.Event()
+    return seq
+
+def close_submission(uid: int, seq: int):
+    done = OPEN_SUBMISSIONS.get(uid, {}).pop(seq, None)
+    if done:
+        done.set()
+
+async def wait_for_turn(job: dict):
+    """Holds an ordered delivery until every job the user submitted earlier has finished.
+
+    Failed and cancelled jobs finish too, so they never block the ones behind them;
+    ORDER_WAIT_MAX bounds the wait for a stuck one.
+    """
+    uid = job["uid"]
+    if not job_settings(job)["ordered"]:
+        return
+    with trace_span(job, "order_wait"):
+        if job.get("queue_id") is not None:
+            deadline = time.monotonic() + ORDER_WAIT_MAX
+            while time.monotonic() < deadline and not job["cancel"].is_set():
+                if not await JOB_QUEUE.unfinished_before(uid, job["queue_id"]):
+                    return
+                await asyncio.sleep(QUEUE_POLL_INTERVAL)
+            return
+        earlier = [done for seq, done in OPEN_SUBMISSIONS.get(uid, {}).items() if job.get("seq") and seq < job["seq"]]
+        if not earlier:
+            return
+        turn = asyncio.ensure_future(asyncio.gather(*(done.wait() for done in earlier)))
+        cancelled = asyncio.ensure_future(job["cancel"].wait())
+        try:
+            await asyncio.wait({turn, cancelled}, timeout=ORDER_WAIT_MAX, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            turn.cancel()
+            cancelled.cancel()
+
+# ---- client pool ----
+def build_client_pool() -> list:
+    """Creates the helper sessions from POOL_BOT_TOKENS / POOL_SESSION_STRINGS (comma-separated)."""
+    helpers = []
+    for i, token in enumerate(t.strip() for t in os.getenv("POOL_BOT_TOKENS", "").split(",") if t.strip()):
+        helpers.append(Client(f"pool_bot_{i}", api_id=API_ID, api_hash=API_HASH, bot_token=token, no_updates=True, max_concurrent_transmissions=MAX_TRANSMISSIONS))
+    for i, session in enumerate(s.strip() for s in os.getenv("POOL_SESSION_STRINGS", "").split(",") if s.strip()):
+        helpers.append(Client(f"pool_user_{i}", api_id=API_ID, api_hash=API_HASH, session_string=session, no_updates=True, max_concurrent_transmissions=MAX_TRANSMISSIONS))
+    return helpers
+
+POOL_HELPERS = build_client_pool()
+
+def pool_clients() -> list:
+    # helpers can't reach the user's private chat, so they only work through the relay chat
+    if POOL_RELAY_CHAT and POOL_HELPERS:
+        return [app] + POOL_HELPERS
+    return [app]
+
+def pick_client() -> Client:
+    """Least-loaded client that is not sitting out a FloodWait."""
+    now = time.monotonic()
+    clients = pool_clients()
+    ready = [cl for cl in clients if CLIENT_FLOOD_UNTIL.get(cl.name, 0) <= now]
+    if not ready:
+        ready = [min(clients, key=lambda cl: CLIENT_FLOOD_UNTIL.get(cl.name, 0))]
+    return min(ready, key=lambda cl: CLIENT_LOAD.get(cl.name, 0))
+
+@asynccontextmanager
+async def lease_client(cl: Client = None):
+    cl = cl or pick_client()
+    CLIENT_LOAD[cl.name] = CLIENT_LOAD.get(cl.name, 0) + 1
+    try:
+        yield cl
+    except FloodWait as e:
+        CLIENT_FLOOD_UNTIL[cl.name] = time.monotonic() + e.value
+        logger.warning("Client %s hit FloodWait of %ss, taking it out of rotation", cl.name, e.value)
+        raise
+    finally:
+        CLIENT_LOAD[cl.name] -= 1
+
+def check_download_size(path, size: int):
+    """Fails a Telegram download whose file on disk is shorter or longer than the media's file_size."""
+    if path and size:
+        actual = Path(path).stat().st_size
+        if actual != size:
+            raise IOError(f"ডাউনলোড অসম্পূর্ণ: {actual}/{size} bytes")
+    return path
+
+async def fast_download_media(cl: Client, msg: Message, out_path: Path, cancel_event: asyncio.Event = None, job: dict = None):
+    """Downloads Telegram media with several concurrent getFile streams writing into a preallocated file.
+
+    The file is cut into parts of DOWNLOAD_PART_CHUNKS 1 MiB chunks; workers
+    pull parts from a queue, write them at their own offset, and a failed
+    part is retried on its own instead of restarting the whole file.
+    """
+    media = msg.video or msg.document
+    size = media.file_size if media else 0
+    if not size or size < FAST_DOWNLOAD_MIN or DOWNLOAD_WORKERS <= 1:
+        path = await cl.download_media(msg, file_name=str(out_path), progress=download_progress, progress_args=(job, {"got": 0}, cancel_event))
+        return check_download_size(path, size)
+
+    chunk = 1024 * 1024  # stream_media always yields 1 MiB chunks
+    total_chunks = math.ceil(size / chunk)
+    parts = asyncio.Queue()
+    for start in range(0, total_chunks, DOWNLOAD_PART_CHUNKS):
+        parts.put_nowait((start, min(start + DOWNLOAD_PART_CHUNKS, total_chunks)))
+
+    with out_path.open("wb") as f:
+        f.truncate(size)
+    fd = os.open(out_path, os.O_WRONLY)
+    started = time.monotonic()
+    # the file is preallocated, so truncation shows up as bytes never written
+    written = 0
+    # pwrite calls still running in a thread; fd must stay open until they return
+    writes = set()
+
+    async def worker():
+        nonlocal written
+        while not parts.empty():
+            await wait_for_memory(job, "tg_part")
+            if parts.empty():
+                break
+            start, end = parts.get_nowait()
+            pos, tries = start, 0
+            while pos < end:
+                if cancel_event and cancel_event.is_set():
+                    return
+                try:
+                    async for data in cl.stream_media(msg, offset=pos, limit=end - pos):
+                        account_buffer(job, len(data))
+                        write = asyncio.ensure_future(asyncio.to_thread(os.pwrite, fd, data, pos * chunk))
+                        writes.add(write)
+                        write.add_done_callback(writes.discard)
+                        try:
+                            # cancelling the part must not abandon a write the thread already started
+                            await asyncio.shield(write)
+                        finally:
+                            account_buffer(job, -len(data))
+                        written += len(data)
+                        pos += 1
+                        await throttle(job, "down", len(data))
+                    if pos < end:
+                        raise IOError(f"stream ended early at chunk {pos}")
+                except FloodWait as e:
+                    await asyncio.sleep(e.value)
+                except Exception as e:
+                    tries += 1
+                    if tries > DOWNLOAD_PART_RETRIES:
+                        raise
+                    logger.warning("Part %s-%s failed at chunk %s (%s), retrying", start, end, pos, e)
+                    await asyncio.sleep(tries)
+
+    tasks = [asyncio.create_task(worker()) for _ in range(DOWNLOAD_WORKERS)]
+    # don't wait for in-flight getFile calls to return once the job is cancelled
+    watcher = on_cancel(cancel_event, lambda: [t.cancel() for t in tasks])
+    try:
+        await asyncio.gather(*tasks)
+    except asyncio.CancelledError:
+        if not (cancel_event and cancel_event.is_set()):
+            raise
+    except Exception as e:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if writes:
+            await asyncio.wait(list(writes))
+        logger.warning("Parallel download failed (%s), falling back to a single stream", e)
+        path = await cl.download_media(msg, file_name=str(out_path), progress=download_progress, progress_args=(job, {"got": 0}, cancel_event))
+        return check_download_size(path, size)
+    finally:
+        if watcher:
+            watcher.cancel()
+        if writes:
+            await asyncio.wait(list(writes))
+        os.close(fd)
+    if cancel_event and cancel_event.is_set():
+        # same contract as download_media after stop_transmission
+        return None
+    if written != size:
+        raise IOError(f"ডাউনলোড অসম্পূর্ণ: {written}/{size} bytes")
+    elapsed = max(time.monotonic() - started, 0.001)
+    logger.info("Parallel download of %s: %.1f MB in %.1fs (%.2f MB/s, %s workers)", out_path.name, size / 1e6, elapsed, size / 1e6 / elapsed, DOWNLOAD_WORKERS)
+    return str(out_path)
+
+async def download_message_media(source: Message, out_path: Path, job: dict = None):
+    """Downloads a message's media through the least-loaded session."""
+    cancel_event = job["cancel"] if job else None
+    cl = pick_client()
+    if cl is app:
+        async with lease_client(app):
+            return await fast_download_media(app, source, out_path, cancel_event=cancel_event, job=job)
+    # the helper can't see the user's chat; copying into the relay chat is
+    # a server-side operation and gives the helper its own file_id. The copy
+    # is app's request, so it runs under app's lease: a FloodWait there
+    # benches app, not the helper.
+    async with lease_client(app):
+        relay = await app.copy_message(POOL_RELAY_CHAT, source.chat.id, source.id)
+    try:
+        async with lease_client(cl):
+            msg = await cl.get_messages(POOL_RELAY_CHAT, relay.id)
+            return await fast_download_media(cl, msg, out_path, cancel_event=cancel_event, job=job)
+    finally:
+        try:
+            await app.delete_messages(POOL_RELAY_CHAT, relay.id)
+        except Exception:
+            pass
+
+async def start_client_pool():
+    for cl in list(POOL_HELPERS):
+        try:
+            await cl.start()
+        except Exception as e:
+            logger.warning("Pool client %s failed to start: %s", cl.name, e)
+            POOL_HELPERS.remove(cl)
+    if POOL_HELPERS and not POOL_RELAY_CHAT:
+        logger.warning("POOL_RELAY_CHAT is not set, pool clients will stay idle.")
+
+async def stop_client_pool():
+    for cl in POOL_HELPERS:
+        try:
+            await cl.stop()
+        except Exception:
+            pass
+
+# ---- thumbnail store ----
+def _encode_thumb(src: Path) -> bytes:
+    with Image.open(src) as img:
+        img.thumbnail((320, 320))
+        img = img.convert("RGB")
+        buf = io.BytesIO()
+        img.save(buf, "JPEG")
+    return buf.getvalue()
+
+def _write_atomic(path: Path, data: bytes):
+    part = path.with_name(path.name + ".part")
+    part.write_bytes(data)
+    os.replace(part, path)
+
+def _cache_thumb(uid: int, path: str, data: bytes):
+    THUMB_CACHE[uid] = (path, data)
+    THUMB_CACHE.move_to_end(uid)
+    while len(THUMB_CACHE) > THUMB_CACHE_SIZE:
+        THUMB_CACHE.popitem(last=False)
+
+async def store_user_thumb(uid: int, src: Path) -> str:
+    """Resizes `src` in a worker thread and saves it as a new thumbnail version."""
+    data = await asyncio.to_thread(_encode_thumb, src)
+    return await save_user_thumb(uid, data)
+
+async def save_user_thumb(uid: int, data: bytes) -> str:
+    path = TMP / f"thumb_{uid}_v{time.time_ns()}.jpg"
+    await asyncio.to_thread(_write_atomic, path, data)
+    old_path = USER_THUMBS.get(uid)
+    USER_THUMBS[uid] = str(path)
+    _cache_thumb(uid, str(path), data)
+    # running uploads hold the old version's bytes, so the file can go
+    if old_path and old_path != str(path):
+        try:
+            Path(old_path).unlink()
+        except Exception:
+            pass
+    return str(path)
+
+async def get_user_thumb(uid: int):
+    """Returns the user's thumbnail JPEG bytes, from memory when possible."""
+    path = USER_THUMBS.get(uid)
+    if not path:
+        return None
+    cached = THUMB_CACHE.get(uid)
+    if cached and cached[0] == path:
+        THUMB_CACHE.move_to_end(uid)
+        return cached[1]
+    try:
+        data = await asyncio.to_thread(Path(path).read_bytes)
+    except Exception:
+        return None
+    _cache_thumb(uid, path, data)
+    return data
+
+def drop_user_thumb(uid: int):
+    THUMB_CACHE.pop(uid, None)
+    return USER_THUMBS.pop(uid, None)
+
+def thumb_file(thumb):
+    """Turns cached thumbnail bytes into a fresh file object for one upload."""
+    if isinstance(thumb, bytes):
+        bio = io.BytesIO(thumb)
+        bio.name = "thumb.jpg"
+        return bio
+    return thumb
+
 # ---- progress callback helpers (removed live progress) ----
 async def progress_callback(current, total, message: Message, start_time, task="Progress"):
     pass
@@ -113,26 +1042,58 @@ def pyrogram_progress_wrapper(current, total, message_obj, start_time_obj, task_
     pass
 
 # ---- robust download stream with retries ----
-async def download_stream(resp, out_path: Path, message: Message = None, cancel_event: asyncio.Event = None):
+async def download_stream(resp, out_path: Path, cancel_event: asyncio.Event = None, job: dict = None):
     total = 0
     try:
         size = int(resp.headers.get("Content-Length", 0))
     except:
         size = 0
-    chunk_size = 1024 * 1024
+    # aiohttp decompresses on the fly, so Content-Length only describes the body we see for identity encoding
+    if resp.headers.get("Content-Encoding", "identity").lower() not in ("", "identity"):
+        size = 0
+    set_job_size(job, size)
+    expected_md5 = None
+    if resp.headers.get("Content-MD5"):
+        try:
+            expected_md5 = base64.b64decode(resp.headers["Content-MD5"])
+        except Exception:
+            expected_md5 = None
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5() if expected_md5 else None
+    # closing the response unblocks a read that is waiting on the network
+    watcher = on_cancel(cancel_event, resp.close)
     try:
         with out_path.open("wb") as f:
-            async for chunk in resp.content.iter_chunked(chunk_size):
+            while True:
+                chunk = await resp.content.read(adaptive_chunk_size())
                 if cancel_event and cancel_event.is_set():
                     return False, "অপারেশন ব্যবহারকারী দ্বারা বাতিল করা হয়েছে।"
                 if not chunk:
                     break
                 total += len(chunk)
                 if total > MAX_SIZE:
-                    return False, "ফাইলের সাইজ 2GB এর বেশি হতে পারে না।"
+                    return False, f"ফাইলের সাইজ {human_size(MAX_SIZE)} এর বেশি হতে পারে না।"
+                if size and total > size:
+                    return False, f"সার্ভার Content-Length ({size}) এর চেয়ে বেশি ডেটা পাঠিয়েছে।"
+                sha256.update(chunk)
+                if md5:
+                    md5.update(chunk)
                 f.write(chunk)
+                await throttle(job, "down", len(chunk))
     except Exception as e:
+        if cancel_event and cancel_event.is_set():
+            return False, "অপারেশন ব্যবহারকারী দ্বারা বাতিল করা হয়েছে।"
         return False, str(e)
+    finally:
+        if watcher:
+            watcher.cancel()
+    if cancel_event and cancel_event.is_set():
+        return False, "অপারেশন ব্যবহারকারী দ্বারা বাতিল করা হয়েছে।"
+    if size and total != size:
+        return False, f"ডাউনলোড অসম্পূর্ণ: {total}/{size} bytes পাওয়া গেছে।"
+    if md5 and md5.digest() != expected_md5:
+        return False, "ডাউনলোড করা ফাইলের Content-MD5 মিলেনি।"
+    FILE_DIGESTS[str(out_path)] = sha256.hexdigest()
     return True, None
 
 async def fetch_with_retries(session, url, method="GET", max_tries=3, **kwargs):
@@ -148,7 +1109,7 @@ async def fetch_with_retries(session, url, method="GET", max_tries=3, **kwargs):
             backoff *= 2
     raise RuntimeError("unreachable")
 
-async def download_url_generic(url: str, out_path: Path, message: Message = None, cancel_event: asyncio.Event = None, max_retries=3):
+async def download_url_generic(url: str, out_path: Path, cancel_event: asyncio.Event = None, max_retries=3, job: dict = None):
     timeout = aiohttp.ClientTimeout(total=7200)
     headers = {"User-Agent": "Mozilla/5.0 (X11; Linux x86_64)"}
     connector = aiohttp.TCPConnector(limit=0, force_close=True)
@@ -166,10 +1127,15 @@ async def download_url_generic(url: str, out_path: Path, message: Message = None
                         return False, "ডাউনলোড ব্যর্থ: HTTP 429 Too Many Requests. সার্ভার আপনার অনুরোধ ব্লক করছে।"
                     elif resp.status != 200:
                         return False, f"ডাউনলোড ব্যর্থ: HTTP {resp.status}"
+                    err = oversize_error(resp)
+                    if err:
+                        return False, err
 
-                    ok, err = await download_stream(resp, out_path, message, cancel_event=cancel_event)
+                    ok, err = await download_stream(resp, out_path, cancel_event=cancel_event, job=job)
                     if ok:
                         return True, None
+                    elif cancel_event and cancel_event.is_set():
+                        return False, err
                     else:
                         logger.warning(f"Download stream failed: {err}. Retrying... (Attempt {attempt + 1}/{max_retries})")
                         await asyncio.sleep(5)  # Wait before retrying
@@ -182,7 +1148,7 @@ async def download_url_generic(url: str, out_path: Path, message: Message = None
             
     return False, f"ডাউনলোড ব্যর্থ: {max_retries} বারের চেষ্টাতেও সফল হয়নি।"
 
-async def download_drive_file(file_id: str, out_path: Path, message: Message = None, cancel_event: asyncio.Event = None, max_retries=3):
+async def download_drive_file(file_id: str, out_path: Path, cancel_event: asyncio.Event = None, max_retries=3, job: dict = None):
     for attempt in range(max_retries):
         if cancel_event and cancel_event.is_set():
             return False, "অপারেশন ব্যবহারকারী দ্বারা বাতিল করা হয়েছে।"
@@ -196,13 +1162,18 @@ async def download_drive_file(file_id: str, out_path: Path, message: Message = N
             async with aiohttp.ClientSession(timeout=timeout, headers=headers, connector=connector) as sess:
                 async with sess.get(base, allow_redirects=True) as resp:
                     if resp.status == 200 and "content-disposition" in (k.lower() for k in resp.headers.keys()):
-                        ok, err = await download_stream(resp, out_path, message, cancel_event=cancel_event)
+                        err = oversize_error(resp)
+                        if err:
+                            return False, err
+                        ok, err = await download_stream(resp, out_path, cancel_event=cancel_event, job=job)
                         if ok: return True, None
+                        if cancel_event and cancel_event.is_set(): return False, err
                         
                     elif resp.status == 403:
                         return False, "ডাউনলোডের জন্য Google Drive থেকে অনুমতি প্রয়োজন বা লিংক পাবলিক নয়।"
 
-                    text = await resp.text(errors="ignore")
+                    with trace_span(job, "drive_token"):
+                        text = await resp.text(errors="ignore")
                     m = re.search(r"confirm=([0-9A-Za-z-_]+)", text)
                     if m:
                         token = m.group(1)
@@ -210,8 +1181,12 @@ async def download_drive_file(file_id: str, out_path: Path, message: Message = N
                         async with sess.get(download_url, allow_redirects=True) as resp2:
                             if resp2.status != 200:
                                 return False, f"HTTP {resp2.status}"
-                            ok, err = await download_stream(resp2, out_path, message, cancel_event=cancel_event)
+                            err = oversize_error(resp2)
+                            if err:
+                                return False, err
+                            ok, err = await download_stream(resp2, out_path, cancel_event=cancel_event, job=job)
                             if ok: return True, None
+                            if cancel_event and cancel_event.is_set(): return False, err
                             
                     for k, v in resp.cookies.items():
                         if k.startswith("download_warning"):
@@ -220,8 +1195,12 @@ async def download_drive_file(file_id: str, out_path: Path, message: Message = N
                             async with sess.get(download_url, allow_redirects=True) as resp2:
                                 if resp2.status != 200:
                                     return False, f"HTTP {resp2.status}"
-                                ok, err = await download_stream(resp2, out_path, message, cancel_event=cancel_event)
+                                err = oversize_error(resp2)
+                                if err:
+                                    return False, err
+                                ok, err = await download_stream(resp2, out_path, cancel_event=cancel_event, job=job)
                                 if ok: return True, None
+                                if cancel_event and cancel_event.is_set(): return False, err
                                 
             logger.warning(f"Drive download failed (stream or token). Retrying... (Attempt {attempt + 1}/{max_retries})")
             await asyncio.sleep(5)
@@ -245,6 +1224,16 @@ async def set_bot_commands():
         BotCommand("view_caption", "আপনার ক্যাপশন দেখুন (admin only)"),
         BotCommand("edit_caption_mode", "শুধু ক্যাপশন এডিট করুন (admin only)"),
         BotCommand("rename", "reply করা ভিডিও রিনেম করুন (admin only)"),
+        BotCommand("contact_sheet", "আপলোডের পর প্রিভিউ কন্টাক্ট শিট মোড টগল করুন (admin only)"),
+        BotCommand("rendition", "এক সোর্স থেকে সব কোয়ালিটি তৈরি মোড টগল করুন (admin only)"),
+        BotCommand("dupcheck", "ডুপ্লিকেট ভিডিও চেক মোড: off/flag/skip/reuse (admin only)"),
+        BotCommand("target_size", "নির্দিষ্ট সাইজে two-pass এনকোড মোড (admin only)"),
+        BotCommand("ordered", "চ্যানেলে জমা দেওয়ার ক্রমে পোস্ট মোড টগল করুন (admin only)"),
+        BotCommand("set_targets", "আপলোডের পর যেসব চ্যানেলে পাঠানো হবে সেট করুন (admin only)"),
+        BotCommand("view_targets", "সেভ করা চ্যানেলগুলো দেখুন (admin only)"),
+        BotCommand("bwlimit", "ব্যান্ডউইথ লিমিট দেখুন/সেট করুন (admin only)"),
+        BotCommand("queue", "শেয়ার্ড কিউ ও worker এর অবস্থা (admin only)"),
+        BotCommand("stats", "সাম্প্রতিক জবের সময়ের হিসাব (admin only)"),
         BotCommand("broadcast", "ব্রডকাস্ট (কেবল অ্যাডমিন)"),
         BotCommand("help", "সহায়িকা")
     ]
@@ -270,6 +1259,17 @@ async def start_handler(c, m: Message):
         "/view_caption - আপনার ক্যাপশন দেখুন (admin only)\n"
         "/edit_caption_mode - শুধু ক্যাপশন এডিট করার মোড টগল করুন (admin only)\n"
         "/rename <newname.ext> - reply করা ভিডিও রিনেম করুন (admin only)\n"
+        "/contact_sheet - আপলোডের পর ভিডিওর প্রিভিউ কন্টাক্ট শিট পাঠানো টগল করুন (admin only)\n"
+        "/rendition - একটি ভিডিও থেকে [re (...)] এর সব কোয়ালিটি তৈরি করে আপলোড মোড টগল করুন (admin only)\n"
+        "/dupcheck <off|flag|skip|reuse> - আগে আপলোড করা ভিডিওর মতো দেখালে সতর্ক/বাদ/আগের ফাইল আবার পাঠানো (admin only)\n"
+        "/target_size <MB|fit|off> [preset] - ভিডিও এই সাইজের মধ্যে two-pass এনকোড করে আপলোড (fit = আপলোড লিমিট) (admin only)\n"
+        "/ordered - একসাথে চলা জবগুলো চ্যানেলে পাঠানোর ক্রমেই পোস্ট হবে, আগের জব শেষ হওয়া পর্যন্ত অপেক্ষা করবে (admin only)\n"
+        "/set_targets <chat ...> - আপলোড একবার করে এই চ্যানেলগুলোতে কপি হবে (admin only)\n"
+        "/view_targets - সেভ করা চ্যানেলগুলো দেখুন (admin only)\n"
+        "(যেকোনো URL বা /rename এর শেষে --to <chat,chat> দিলে শুধু সেই জবের জন্য চ্যানেল বদলাবে)\n"
+        "/bwlimit <down> <up> [job] [small%] - ব্যান্ডউইথ লিমিট MB/s এ (0 = আনলিমিটেড) (admin only)\n"
+        "/queue - কিউতে থাকা ও worker এ চলমান জব (admin only)\n"
+        "/stats [export] - সাম্প্রতিক জবের প্রতিটি ধাপের সময় ও percentile (admin only)\n"
         "/broadcast <text> - ব্রডকাস্ট (শুধুমাত্র অ্যাডমিন)\n"
         "/help - সাহায্য"
     )
@@ -305,11 +1305,11 @@ async def view_thumb_cmd(c, m: Message):
         await m.reply_text("আপনার অনুমতি নেই এই কমান্ড চালানোর।")
         return
     uid = m.from_user.id
-    thumb_path = USER_THUMBS.get(uid)
+    thumb = await get_user_thumb(uid)
     thumb_time = USER_THUMB_TIME.get(uid)
     
-    if thumb_path and Path(thumb_path).exists():
-        await c.send_photo(chat_id=m.chat.id, photo=thumb_path, caption="এটা আপনার সেভ করা থাম্বনেইল।")
+    if thumb:
+        await c.send_photo(chat_id=m.chat.id, photo=thumb_file(thumb), caption="এটা আপনার সেভ করা থাম্বনেইল।")
     elif thumb_time:
         await m.reply_text(f"আপনার থাম্বনেইল তৈরির সময় সেট করা আছে: {thumb_time} সেকেন্ড।")
     else:
@@ -321,13 +1321,12 @@ async def del_thumb_cmd(c, m: Message):
         await m.reply_text("আপনার অনুমতি নেই এই কমান্ড চালানোর।")
         return
     uid = m.from_user.id
-    thumb_path = USER_THUMBS.get(uid)
+    thumb_path = drop_user_thumb(uid)
     if thumb_path and Path(thumb_path).exists():
         try:
             Path(thumb_path).unlink()
         except Exception:
             pass
-        USER_THUMBS.pop(uid, None)
     
     if uid in USER_THUMB_TIME:
         USER_THUMB_TIME.pop(uid)
@@ -345,19 +1344,21 @@ async def photo_handler(c, m: Message):
     uid = m.from_user.id
     if uid in SET_THUMB_REQUEST:
         SET_THUMB_REQUEST.discard(uid)
-        out = TMP / f"thumb_{uid}.jpg"
+        src = TMP / f"thumb_src_{uid}_{time.time_ns()}.jpg"
         try:
-            await m.download(file_name=str(out))
-            img = Image.open(out)
-            img.thumbnail((320, 320))
-            img = img.convert("RGB")
-            img.save(out, "JPEG")
-            USER_THUMBS[uid] = str(out)
+            await m.download(file_name=str(src))
+            await store_user_thumb(uid, src)
             # Make sure to clear the time setting if a photo is set
             USER_THUMB_TIME.pop(uid, None)
             await m.reply_text("আপনার থাম্বনেইল সেভ হয়েছে।")
         except Exception as e:
             await m.reply_text(f"থাম্বনেইল সেভ করতে সমস্যা: {e}")
+        finally:
+            try:
+                if src.exists():
+                    src.unlink()
+            except Exception:
+                pass
     else:
         pass
 
@@ -370,6 +1371,7 @@ async def set_caption_prompt(c, m: Message):
     SET_CAPTION_REQUEST.add(m.from_user.id)
     # Reset counter data when a new caption is about to be set
     USER_COUNTERS.pop(m.from_user.id, None)
+    FREE_CAPTION_SLOTS.pop(m.from_user.id, None)
     await m.reply_text("ক্যাপশন দিন। কোড - [01 (+01, 01u)], [re (480p, 720p, 1080p)]")
 
 @app.on_message(filters.command("view_caption") & filters.private)
@@ -393,6 +1395,7 @@ async def delete_caption_cb(c, cb):
     if uid in USER_CAPTIONS:
         USER_CAPTIONS.pop(uid)
         USER_COUNTERS.pop(uid, None) # New: delete counter data
+        FREE_CAPTION_SLOTS.pop(uid, None)
         await cb.message.edit_text("আপনার ক্যাপশন মুছে ফেলা হয়েছে।")
     else:
         await cb.answer("আপনার কোনো ক্যাপশন সেভ করা নেই।", show_alert=True)
@@ -412,6 +1415,208 @@ async def toggle_edit_caption_mode(c, m: Message):
         EDIT_CAPTION_MODE.add(uid)
         await m.reply_text("edit video caption mod on.\nএখন থেকে শুধু সেভ করা ক্যাপশন ভিডিওতে যুক্ত হবে। ভিডিওর নাম এবং থাম্বনেইল একই থাকবে।")
 
+@app.on_message(filters.command("rendition") & filters.private)
+async def toggle_rendition_mode(c, m: Message):
+    uid = m.from_user.id
+    if not is_admin(uid):
+        await m.reply_text("আপনার অনুমতি নেই এই কমান্ড চালানোর।")
+        return
+
+    if uid in RENDITION_MODE:
+        RENDITION_MODE.discard(uid)
+        await m.reply_text("rendition mode off.\nএখন থেকে প্রতিটি ভিডিও যেমন আছে তেমন আপলোড হবে।")
+    else:
+        RENDITION_MODE.add(uid)
+        labels = ", ".join(rendition_labels(USER_CAPTIONS.get(uid)))
+        await m.reply_text(f"rendition mode on.\nএখন থেকে প্রতিটি ভিডিও একবার ডিকোড করে এই কোয়ালিটিগুলোতে আপলোড হবে: {labels}")
+
+@app.on_message(filters.command("contact_sheet") & filters.private)
+async def toggle_contact_sheet_mode(c, m: Message):
+    uid = m.from_user.id
+    if not is_admin(uid):
+        await m.reply_text("আপনার অনুমতি নেই এই কমান্ড চালানোর।")
+        return
+
+    if uid in CONTACT_SHEET_MODE:
+        CONTACT_SHEET_MODE.discard(uid)
+        await m.reply_text("contact sheet mode off.")
+    else:
+        CONTACT_SHEET_MODE.add(uid)
+        await m.reply_text("contact sheet mode on.\nএখন থেকে প্রতিটি ভিডিও আপলোডের পর প্রিভিউ ফ্রেমগুলোর একটি কন্টাক্ট শিট পাঠানো হবে।")
+
+@app.on_message(filters.command("dupcheck") & filters.private)
+async def dupcheck_cmd(c, m: Message):
+    uid = m.from_user.id
+    if not is_admin(uid):
+        await m.reply_text("আপনার অনুমতি নেই এই কমান্ড চালানোর।")
+        return
+    modes = ("off", "flag", "skip", "reuse")
+    if len(m.command) < 2 or m.command[1].lower() not in modes:
+        current = USER_DUP_MODE.get(uid, DUPCHECK_DEFAULT)
+        await m.reply_text(
+            f"বর্তমান মোড: {current}\n"
+            "ব্যবহার: /dupcheck <off|flag|skip|reuse>\n"
+            "flag - সতর্ক করে আপলোড চালিয়ে যাবে\n"
+            "skip - ডুপ্লিকেট হলে আপলোড বাদ দেবে\n"
+            "reuse - আপলোড ছাড়াই আগের ফাইলটি আবার পাঠাবে"
+        )
+        return
+    USER_DUP_MODE[uid] = m.command[1].lower()
+    await m.reply_text(f"dupcheck mode: {USER_DUP_MODE[uid]}")
+
+@app.on_message(filters.command("target_size") & filters.private)
+async def target_size_cmd(c, m: Message):
+    uid = m.from_user.id
+    if not is_admin(uid):
+        await m.reply_text("আপনার অনুমতি নেই এই কমান্ড চালানোর।")
+        return
+    args = m.command[1:]
+    if args and args[0].lower() == "off":
+        USER_TARGET_SIZE.pop(uid, None)
+        await m.reply_text("target size mode off.")
+        return
+    preset = args[1].lower() if len(args) > 1 else TARGET_PRESET
+    try:
+        if not args or preset not in X264_PRESETS:
+            raise ValueError
+        target_bytes = UPLOAD_LIMIT if args[0].lower() == "fit" else int(float(args[0]) * 1024 * 1024)
+        if target_bytes <= 0:
+            raise ValueError
+    except ValueError:
+        current = USER_TARGET_SIZE.get(uid)
+        state = f"{human_size(current[0])}, {current[1]}" if current else "off"
+        await m.reply_text(
+            f"বর্তমান: {state}\n"
+            "ব্যবহার: /target_size <MB|fit|off> [preset]\n"
+            "উদাহরণ: /target_size 300 slow\n"
+            f"preset: {', '.join(X264_PRESETS)}"
+        )
+        return
+    USER_TARGET_SIZE[uid] = (min(target_bytes, UPLOAD_LIMIT), preset)
+    await m.reply_text(f"target size mode on: {human_size(USER_TARGET_SIZE[uid][0])} ({preset})\nএর চেয়ে বড় ভিডিও two-pass এনকোড করে এই সাইজে আনা হবে।")
+
+@app.on_message(filters.command("ordered") & filters.private)
+async def toggle_ordered_delivery(c, m: Message):
+    uid = m.from_user.id
+    if not is_admin(uid):
+        await m.reply_text("আপনার অনুমতি নেই এই কমান্ড চালানোর।")
+        return
+
+    if uid in ORDERED_DELIVERY:
+        ORDERED_DELIVERY.discard(uid)
+        await m.reply_text("ordered mode off.\nপ্রতিটি জব শেষ হওয়া মাত্রই চ্যানেলে পাঠানো হবে।")
+    else:
+        ORDERED_DELIVERY.add(uid)
+        await m.reply_text("ordered mode on.\nডাউনলোড/কনভার্ট/আপলোড একসাথে চলবে, কিন্তু চ্যানেলে ফাইলগুলো আপনি যে ক্রমে পাঠিয়েছেন সেই ক্রমে যাবে।")
+
+@app.on_message(filters.command("set_targets") & filters.private)
+async def set_targets_cmd(c, m: Message):
+    uid = m.from_user.id
+    if not is_admin(uid):
+        await m.reply_text("আপনার অনুমতি নেই এই কমান্ড চালানোর।")
+        return
+    targets = parse_targets(m.text.split(None, 1)[1]) if len(m.command) > 1 else []
+    if not targets:
+        await m.reply_text("ব্যবহার: /set_targets <chat ...>\nউদাহরণ: /set_targets @mychannel -1001234567890\n(বটকে প্রতিটি চ্যানেলে অ্যাডমিন হতে হবে)")
+        return
+    USER_TARGETS[uid] = targets
+    await m.reply_text(f"ডেলিভারি চ্যানেল সেভ হয়েছে: {', '.join(str(t) for t in targets)}\nএখন থেকে প্রতিটি ফাইল একবার আপলোড হয়ে এই চ্যানেলগুলোতে কপি হবে।")
+
+@app.on_message(filters.command("view_targets") & filters.private)
+async def view_targets_cmd(c, m: Message):
+    uid = m.from_user.id
+    if not is_admin(uid):
+        await m.reply_text("আপনার অনুমতি নেই এই কমান্ড চালানোর।")
+        return
+    targets = USER_TARGETS.get(uid)
+    if targets:
+        await m.reply_text(f"আপনার ডেলিভারি চ্যানেল:\n\n{chr(10).join(str(t) for t in targets)}", reply_markup=delete_targets_keyboard())
+    else:
+        await m.reply_text("আপনার কোনো ডেলিভারি চ্যানেল সেভ করা নেই। /set_targets দিয়ে সেট করুন।")
+
+@app.on_callback_query(filters.regex("delete_targets"))
+async def delete_targets_cb(c, cb):
+    uid = cb.from_user.id
+    if not is_admin(uid):
+        await cb.answer("আপনার অনুমতি নেই।", show_alert=True)
+        return
+    if USER_TARGETS.pop(uid, None):
+        await cb.message.edit_text("আপনার ডেলিভারি চ্যানেল মুছে ফেলা হয়েছে।")
+    else:
+        await cb.answer("আপনার কোনো ডেলিভারি চ্যানেল সেভ করা নেই।", show_alert=True)
+
+def format_bw_limits() -> str:
+    def fmt(rate):
+        return "আনলিমিটেড" if rate <= 0 else f"{rate / 1024 / 1024:.2f} MB/s"
+    return (
+        f"ডাউনলোড: {fmt(BW_LIMITS['down'])}\n"
+        f"আপলোড: {fmt(BW_LIMITS['up'])}\n"
+        f"প্রতি জব: {fmt(BW_LIMITS['job'])}\n"
+        f"ছোট ফাইলের সংরক্ষিত অংশ: {BW_LIMITS['small_share'] * 100:.0f}%\n"
+        f"চলমান জব: {len(JOBS)}"
+    )
+
+@app.on_message(filters.command("bwlimit") & filters.private)
+async def bwlimit_cmd(c, m: Message):
+    if not is_admin(m.from_user.id):
+        await m.reply_text("আপনার অনুমতি নেই এই কমান্ড চালানোর।")
+        return
+    args = m.command[1:]
+    if args:
+        try:
+            values = [float(a) for a in args[:4]]
+        except ValueError:
+            await m.reply_text("ব্যবহার: /bwlimit <down> <up> [job] [small%]\nউদাহরণ: /bwlimit 10 5 2 30")
+            return
+        for key, value in zip(("down", "up", "job"), values):
+            BW_LIMITS[key] = max(value, 0) * 1024 * 1024
+        if len(values) > 3:
+            BW_LIMITS["small_share"] = min(max(values[3], 0), 100) / 100
+        for job in JOBS.values():
+            job["down"].set_rate(BW_LIMITS["job"])
+            job["up"].set_rate(BW_LIMITS["job"])
+        rebalance_lanes()
+    await m.reply_text(f"ব্যান্ডউইথ লিমিট:\n{format_bw_limits()}")
+
+@app.on_message(filters.command("stats") & filters.private)
+async def stats_cmd(c, m: Message):
+    if not is_admin(m.from_user.id):
+        await m.reply_text("আপনার অনুমতি নেই এই কমান্ড চালানোর।")
+        return
+    if len(m.command) > 1 and m.command[1].lower() == "export":
+        if not TRACE_HISTORY:
+            await m.reply_text("এখনো কোনো জবের হিসাব নেই।")
+            return
+        data = "".join(json.dumps(t, ensure_ascii=False) + "\n" for t in TRACE_HISTORY).encode()
+        doc = io.BytesIO(data)
+        doc.name = f"job_traces_{int(time.time())}.jsonl"
+        await c.send_document(chat_id=m.chat.id, document=doc, caption=f"{len(TRACE_HISTORY)} টি জবের হিসাব")
+        return
+
+    lines = [
+        f"মেমরি: {human_size(current_rss())} / {human_size(MEMORY_LIMIT)} (chunk {human_size(adaptive_chunk_size())})",
+        f"চলমান জব: {len(JOBS)}",
+    ]
+    for job in JOBS.values():
+        line = f"• {job['kind']} [{job['lane']}] বাফার {human_size(job['buffered'])} (সর্বোচ্চ {human_size(job['buffer_peak'])})"
+        if job.get("api_calls"):
+            line += f", {format_api_calls(job['api_calls'])}"
+        lines.append(line)
+    lines.append("")
+    recent = list(TRACE_HISTORY)[-STATS_RECENT:]
+    if recent:
+        lines.append("সাম্প্রতিক জব:")
+        lines += [f"• {format_job_trace(t)}" for t in reversed(recent)]
+    else:
+        lines.append("এখনো কোনো জব শেষ হয়নি।")
+    percentiles = stage_percentiles()
+    if percentiles:
+        lines += ["", "ধাপ (সংখ্যা: p50 / p90 / p99):"]
+        for stage, (count, p50, p90, p99) in sorted(percentiles.items()):
+            lines.append(f"{stage} ({count}): {p50:.1f}s / {p90:.1f}s / {p99:.1f}s")
+    text = "\n".join(lines)
+    await m.reply_text(text[:4000])
+
 
 @app.on_message(filters.text & filters.private)
 async def text_handler(c, m: Message):
@@ -425,12 +1630,14 @@ async def text_handler(c, m: Message):
         SET_CAPTION_REQUEST.discard(uid)
         USER_CAPTIONS[uid] = text
         USER_COUNTERS.pop(uid, None) # New: reset counter on new caption set
+        FREE_CAPTION_SLOTS.pop(uid, None)
         await m.reply_text("আপনার ক্যাপশন সেভ হয়েছে। এখন থেকে আপলোড করা ভিডিওতে এই ক্যাপশন ব্যবহার হবে।")
         return
 
     # Handle auto URL upload
     if text.startswith("http://") or text.startswith("https://"):
-        asyncio.create_task(handle_url_download_and_upload(c, m, text))
+        url, targets = split_targets_arg(text)
+        asyncio.create_task(dispatch_job(c, m, "url", url=url, targets=targets))
     
 @app.on_message(filters.command("upload_url") & filters.private)
 async def upload_url_cmd(c, m: Message):
@@ -438,74 +1645,78 @@ async def upload_url_cmd(c, m: Message):
         await m.reply_text("আপনার অনুমতি নেই এই কমান্ড চালানোর।")
         return
     if not m.command or len(m.command) < 2:
-        await m.reply_text("ব্যবহার: /upload_url <url>\nউদাহরণ: /upload_url https://example.com/file.mp4")
+        await m.reply_text("ব্যবহার: /upload_url <url> [--to <chat,chat>]\nউদাহরণ: /upload_url https://example.com/file.mp4")
         return
-    url = m.text.split(None, 1)[1].strip()
-    asyncio.create_task(handle_url_download_and_upload(c, m, url))
+    url, targets = split_targets_arg(m.text.split(None, 1)[1].strip())
+    asyncio.create_task(dispatch_job(c, m, "url", url=url, targets=targets))
 
-async def handle_url_download_and_upload(c: Client, m: Message, url: str):
+async def handle_url_download_and_upload(c: Client, m: Message, url: str, targets: list = None):
     uid = m.from_user.id
     cancel_event = asyncio.Event()
     TASKS.setdefault(uid, []).append(cancel_event)
+    job = new_job(uid, "url", cancel_event=cancel_event)
+    job["targets"] = targets
+    status = StatusMessage(c, m, job)
 
-    try:
-        status_msg = await m.reply_text("ডাউনলোড শুরু হচ্ছে...", reply_markup=progress_keyboard())
-    except Exception:
-        status_msg = await m.reply_text("ডাউনলোড শুরু হচ্ছে...", reply_markup=progress_keyboard())
     try:
         fname = url.split("/")[-1].split("?")[0] or f"download_{int(datetime.now().timestamp())}"
         safe_name = re.sub(r"[\\/*?\"<>|:]", "_", fname)
+        # a URL message carries no media, so only a real video extension in the
+        # name makes this a video; the .mp4 fallback below must not count
+        is_video = Path(safe_name).suffix.lower() in VIDEO_EXTS
 
-        video_exts = {".mp4", ".mkv", ".avi", ".mov", ".flv", ".wmv", ".webm"}
-        if not any(safe_name.lower().endswith(ext) for ext in video_exts):
+        if not safe_name.lower().endswith(tuple(VIDEO_EXTS) + ARCHIVE_EXTS):
             safe_name += ".mp4"
 
         tmp_in = TMP / f"dl_{uid}_{int(datetime.now().timestamp())}_{safe_name}"
         ok, err = False, None
         
-        try:
-            await status_msg.edit("ডাউনলোড হচ্ছে...", reply_markup=progress_keyboard())
-        except Exception:
-            status_msg = await m.reply_text("ডাউনলোড হচ্ছে...", reply_markup=progress_keyboard())
+        await status.update("ডাউনলোড হচ্ছে...")
 
+        await wait_for_memory(job, "download")
         if is_drive_url(url):
             fid = extract_drive_id(url)
             if not fid:
-                try:
-                    await status_msg.edit("Google Drive লিঙ্ক থেকে file id পাওয়া যায়নি। সঠিক লিংক দিন।", reply_markup=None)
-                except Exception:
-                    await m.reply_text("Google Drive লিঙ্ক থেকে file id পাওয়া যায়নি। সঠিক লিংক দিন।", reply_markup=None)
-                TASKS[uid].remove(cancel_event)
+                await status.finish("Google Drive লিঙ্ক থেকে file id পাওয়া যায়নি। সঠিক লিংক দিন।")
                 return
-            ok, err = await download_drive_file(fid, tmp_in, status_msg, cancel_event=cancel_event)
+            with trace_span(job, "download") as span:
+                ok, err = await download_drive_file(fid, tmp_in, cancel_event=cancel_event, job=job)
+                span["bytes"] = tmp_in.stat().st_size if ok else 0
         else:
-            ok, err = await download_url_generic(url, tmp_in, status_msg, cancel_event=cancel_event)
+            if is_video:
+                # fingerprint straight from the URL with ranged seeks, so a known video is never downloaded
+                duplicate, fingerprint = await check_duplicate(c, m, job, url)
+                if duplicate:
+                    await deliver_job_uploads(c, m, job)
+                    return
+                if fingerprint[0] is not None:
+                    job["fingerprint"] = fingerprint
+            with trace_span(job, "download") as span:
+                ok, err = await download_url_generic(url, tmp_in, cancel_event=cancel_event, job=job)
+                span["bytes"] = tmp_in.stat().st_size if ok else 0
 
         if not ok:
-            try:
-                await status_msg.edit(f"ডাউনলোড ব্যর্থ: {err}", reply_markup=None)
-            except Exception:
-                await m.reply_text(f"ডাউনলোড ব্যর্থ: {err}", reply_markup=None)
+            job["error"] = err
+            if not cancel_event.is_set():
+                await status.finish(f"ডাউনলোড ব্যর্থ: {err}")
             try:
                 if tmp_in.exists():
                     tmp_in.unlink()
             except:
                 pass
-            TASKS[uid].remove(cancel_event)
             return
 
-        try:
-            await status_msg.edit("ডাউনলোড সম্পন্ন, Telegram-এ আপলোড হচ্ছে...", reply_markup=None)
-        except Exception:
-            await m.reply_text("ডাউনলোড সম্পন্ন, Telegram-এ আপলোড হচ্ছে...", reply_markup=None)
-        await process_file_and_upload(c, m, tmp_in, original_name=safe_name, messages_to_delete=[status_msg.id])
+        await status.update("ডাউনলোড সম্পন্ন, Telegram-এ আপলোড হচ্ছে...")
+        await process_file_and_upload(c, m, tmp_in, original_name=safe_name, job=job, is_video=is_video)
     except Exception as e:
         traceback.print_exc()
-        try:
-            await status_msg.edit(f"অপস! কিছু ভুল হয়েছে: {e}", reply_markup=None)
-        except Exception:
-            await m.reply_text(f"অপস! কিছু ভুল হয়েছে: {e}", reply_markup=None)
+        job["error"] = str(e)
+        await status.finish(f"অপস! কিছু ভুল হয়েছে: {e}")
     finally:
+        await report_delivery(m, job)
+        # one delete for the whole job, unless a final state was left above
+        await status.finish()
+        finish_job(job)
         try:
             TASKS[uid].remove(cancel_event)
         except Exception:
@@ -610,7 +1821,10 @@ async def forwarded_file_rename(c: Client, m: Message):
     if uid in EDIT_CAPTION_MODE:
         await handle_caption_only_upload(c, m)
         return
+    await dispatch_job(c, m, "forward")
 
+async def run_forwarded_upload(c: Client, m: Message):
+    uid = m.from_user.id
     cancel_event = asyncio.Event()
     TASKS.setdefault(uid, []).append(cancel_event)
     
@@ -622,22 +1836,30 @@ async def forwarded_file_rename(c: Client, m: Message):
         original_name = f"video_{file_info.file_unique_id}.mp4"
     else:
         original_name = f"file_{file_info.file_unique_id}"
-
-    try:
-        status_msg = await m.reply_text("ফরওয়ার্ড করা ফাইল ডাউনলোড শুরু হচ্ছে...", reply_markup=progress_keyboard())
-    except Exception:
-        status_msg = await m.reply_text("ফরওয়ার্ড করা ফাইল ডাউনলোড শুরু হচ্ছে...", reply_markup=progress_keyboard())
+    job = new_job(uid, "forward", size=file_info.file_size or 0, cancel_event=cancel_event)
+    status = StatusMessage(c, m, job)
     tmp_path = TMP / f"forwarded_{uid}_{int(datetime.now().timestamp())}_{original_name}"
     try:
-        await m.download(file_name=str(tmp_path))
-        try:
-            await status_msg.edit("ডাউনলোড সম্পন্ন, এখন Telegram-এ আপলোড হচ্ছে...", reply_markup=None)
-        except Exception:
-            await m.reply_text("ডাউনলোড সম্পন্ন, এখন Telegram-এ আপলোড হচ্ছে...", reply_markup=None)
-        await process_file_and_upload(c, m, tmp_path, original_name=original_name, messages_to_delete=[status_msg.id])
+        await status.update("ফরওয়ার্ড করা ফাইল ডাউনলোড হচ্ছে...")
+        await wait_for_memory(job, "tg_download")
+        with trace_span(job, "tg_download", file_info.file_size or 0):
+            await download_message_media(m, tmp_path, job=job)
+        if cancel_event.is_set():
+            return
+        await status.update("ডাউনলোড সম্পন্ন, এখন Telegram-এ আপলোড হচ্ছে...")
+        await process_file_and_upload(c, m, tmp_path, original_name=original_name, job=job)
     except Exception as e:
-        await m.reply_text(f"ফাইল প্রসেসিংয়ে সমস্যা: {e}")
+        job["error"] = str(e)
+        await status.finish(f"ফাইল প্রসেসিংয়ে সমস্যা: {e}")
     finally:
+        await report_delivery(m, job)
+        await status.finish()
+        finish_job(job)
+        try:
+            if tmp_path.exists():
+                tmp_path.unlink()
+        except Exception:
+            pass
         try:
             TASKS[uid].remove(cancel_event)
         except Exception:
@@ -655,27 +1877,44 @@ async def rename_cmd(c, m: Message):
     if len(m.command) < 2:
         await m.reply_text("নতুন ফাইল নাম দিন। উদাহরণ: /rename new_video.mp4")
         return
-    new_name = m.text.split(None, 1)[1].strip()
+    new_name, targets = split_targets_arg(m.text.split(None, 1)[1].strip())
     new_name = re.sub(r"[\\/*?\"<>|:]", "_", new_name)
     await m.reply_text(f"ভিডিও রিনেম করা হবে: {new_name}\n(রিনেম করতে reply করা ফাইলটি পুনরায় ডাউনলোড করে আপলোড করা হবে)")
+    await dispatch_job(c, m, "rename", new_name=new_name, targets=targets)
 
+async def run_rename(c: Client, m: Message, new_name: str, targets: list = None):
+    uid = m.from_user.id
     cancel_event = asyncio.Event()
     TASKS.setdefault(uid, []).append(cancel_event)
-    try:
-        status_msg = await m.reply_text("রিনেমের জন্য ফাইল ডাউনলোড করা হচ্ছে...", reply_markup=progress_keyboard())
-    except Exception:
-        status_msg = await m.reply_text("রিনেমের জন্য ফাইল ডাউনলোড করা হচ্ছে...", reply_markup=progress_keyboard())
+    source_info = m.reply_to_message.video or m.reply_to_message.document
+    job = new_job(uid, "rename", size=source_info.file_size or 0, cancel_event=cancel_event)
+    job["targets"] = targets
+    status = StatusMessage(c, m, job)
     tmp_out = TMP / f"rename_{uid}_{int(datetime.now().timestamp())}_{new_name}"
     try:
-        await m.reply_to_message.download(file_name=str(tmp_out))
-        try:
-            await status_msg.edit("ডাউনলোড সম্পন্ন, এখন নতুন নাম দিয়ে আপলোড হচ্ছে...", reply_markup=None)
-        except Exception:
-            await m.reply_text("ডাউনলোড সম্পন্ন, এখন নতুন নাম দিয়ে আপলোড হচ্ছে...", reply_markup=None)
-        await process_file_and_upload(c, m, tmp_out, original_name=new_name, messages_to_delete=[status_msg.id])
+        await status.update("রিনেমের জন্য ফাইল ডাউনলোড করা হচ্ছে...")
+        await wait_for_memory(job, "tg_download")
+        with trace_span(job, "tg_download", source_info.file_size or 0):
+            await download_message_media(m.reply_to_message, tmp_out, job=job)
+        if cancel_event.is_set():
+            return
+        await status.update("ডাউনলোড সম্পন্ন, এখন নতুন নাম দিয়ে আপলোড হচ্ছে...")
+        # m is the /rename command itself; the replied-to file decides whether this is a video
+        is_video = bool(m.reply_to_message.video) or Path(new_name).suffix.lower() in VIDEO_EXTS
+        # a rename re-uploads the file itself, archive or not
+        await process_file_and_upload(c, m, tmp_out, original_name=new_name, job=job, is_video=is_video, expand_archives=False)
     except Exception as e:
-        await m.reply_text(f"রিনেম ত্রুটি: {e}")
+        job["error"] = str(e)
+        await status.finish(f"রিনেম ত্রুটি: {e}")
     finally:
+        await report_delivery(m, job)
+        await status.finish()
+        finish_job(job)
+        try:
+            if tmp_out.exists():
+                tmp_out.unlink()
+        except Exception:
+            pass
         try:
             TASKS[uid].remove(cancel_event)
         except Exception:
@@ -684,12 +1923,21 @@ async def rename_cmd(c, m: Message):
 @app.on_callback_query(filters.regex("cancel_task"))
 async def cancel_task_cb(c, cb):
     uid = cb.from_user.id
-    if uid in TASKS and TASKS[uid]:
-        for ev in list(TASKS[uid]):
+    # queued jobs and the ones running on workers stop at their next heartbeat
+    remote = await JOB_QUEUE.request_cancel(uid) if ROLE == "front" else 0
+    if remote or TASKS.get(uid):
+        for ev in list(TASKS.get(uid, [])):
             try:
                 ev.set()
             except:
                 pass
+        now = time.monotonic()
+        for job in JOBS.values():
+            if job["uid"] == uid:
+                job.setdefault("cancelled_at", now)
+                # the message deleted below is this job's status; don't spend calls on it again
+                if job.get("status") and job["status"].msg_id == cb.message.id:
+                    job["status"].closed = True
         await cb.answer("অপারেশন বাতিল করা হয়েছে।", show_alert=True)
         try:
             await cb.message.delete()
@@ -698,47 +1946,635 @@ async def cancel_task_cb(c, cb):
     else:
         await cb.answer("কোনো অপারেশন চলছে না।", show_alert=True)
 
+# ---- job queue (front/worker split) ----
+QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    uid INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued',
+    worker TEXT,
+    lease_until REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    stage TEXT,
+    cancel INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    unused_slots TEXT,
+    notified INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+)
+"""
+
+class SqliteJobQueue:
+    """Shared job queue in a SQLite file: enough for workers on one machine, and for tests.
+
+    Jobs move queued -> running -> done/failed/cancelled. A running job whose lease
+    ran out (its worker stopped heartbeating) is handed to the next worker that
+    polls, until QUEUE_MAX_ATTEMPTS is used up.
+    """
+
+    def __init__(self, path: Path):
+        self.path = str(path)
+        with closing(self._connect()) as db:
+            db.execute(QUEUE_SCHEMA)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def _enqueue(self, uid: int, payload: dict) -> int:
+        now = time.time()
+        with closing(self._connect()) as db:
+            cur = db.execute("INSERT INTO jobs (uid, payload, created, updated) VALUES (?, ?, ?, ?)", (uid, json.dumps(payload), now, now))
+            return cur.lastrowid
+
+    def _claim(self, worker: str, lease: float):
+        now = time.time()
+        with closing(self._connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute(
+                    "UPDATE jobs SET state = 'failed', error = 'worker lost', updated = ? WHERE state = 'running' AND lease_until < ? AND attempts >= ?",
+                    (now, now, QUEUE_MAX_ATTEMPTS)
+                )
+                row = db.execute(
+                    "SELECT * FROM jobs WHERE state = 'queued' OR (state = 'running' AND lease_until < ?) ORDER BY id LIMIT 1", (now,)
+                ).fetchone()
+                if row:
+                    db.execute(
+                        "UPDATE jobs SET state = 'running', worker = ?, lease_until = ?, attempts = attempts + 1, stage = NULL, updated = ? WHERE id = ?",
+                        (worker, now + lease, now, row["id"])
+                    )
+                    row = db.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        if not row:
+            return None
+        doc = dict(row)
+        doc["payload"] = json.loads(doc["payload"])
+        return doc
+
+    def _heartbeat(self, job_id: int, worker: str, lease: float, stage: str):
+        now = time.time()
+        with closing(self._connect()) as db:
+            cur = db.execute(
+                "UPDATE jobs SET lease_until = ?, stage = ?, updated = ? WHERE id = ? AND worker = ? AND state = 'running'",
+                (now + lease, stage, now, job_id, worker)
+            )
+            if cur.rowcount != 1:
+                return False, False
+            row = db.execute("SELECT cancel FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            return True, bool(row["cancel"])
+
+    def _complete(self, job_id: int, worker: str, state: str, error: str = None, unused_slots: list = None):
+        with closing(self._connect()) as db:
+            db.execute(
+                "UPDATE jobs SET state = ?, error = ?, unused_slots = ?, notified = 1, updated = ? WHERE id = ? AND worker = ? AND state = 'running'",
+                (state, error, json.dumps(unused_slots) if unused_slots else None, time.time(), job_id, worker)
+            )
+
+    def _request_cancel(self, uid: int) -> int:
+        now = time.time()
+        with closing(self._connect()) as db:
+            for row in db.execute("SELECT id, payload FROM jobs WHERE uid = ? AND state = 'queued'", (uid,)).fetchall():
+                slots = json.loads(row["payload"]).get("caption_slots")
+                db.execute("UPDATE jobs SET unused_slots = ? WHERE id = ?", (json.dumps(slots) if slots else None, row["id"]))
+            queued = db.execute("UPDATE jobs SET state = 'cancelled', notified = 1, updated = ? WHERE uid = ? AND state = 'queued'", (now, uid)).rowcount
+            running = db.execute("UPDATE jobs SET cancel = 1, updated = ? WHERE uid = ? AND state = 'running'", (now, uid)).rowcount
+            return queued + running
+
+    def _unfinished_before(self, uid: int, job_id: int) -> int:
+        with closing(self._connect()) as db:
+            row = db.execute("SELECT COUNT(*) FROM jobs WHERE uid = ? AND id < ? AND state IN ('queued', 'running')", (uid, job_id)).fetchone()
+            return row[0]
+
+    def _take_unused_slots(self) -> list:
+        with closing(self._connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            rows = db.execute("SELECT id, uid, unused_slots FROM jobs WHERE unused_slots IS NOT NULL").fetchall()
+            db.executemany("UPDATE jobs SET unused_slots = NULL WHERE id = ?", [(r["id"],) for r in rows])
+            db.execute("COMMIT")
+        return [(r["uid"], json.loads(r["unused_slots"])) for r in rows]
+
+    def _active(self) -> list:
+        with closing(self._connect()) as db:
+            rows = db.execute("SELECT id, uid, state, worker, stage, attempts, created FROM jobs WHERE state IN ('queued', 'running') ORDER BY id").fetchall()
+            return [dict(r) for r in rows]
+
+    def _take_unnotified(self) -> list:
+        with closing(self._connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            rows = db.execute("SELECT * FROM jobs WHERE notified = 0 AND state IN ('done', 'failed', 'cancelled')").fetchall()
+            db.executemany("UPDATE jobs SET notified = 1 WHERE id = ?", [(r["id"],) for r in rows])
+            db.execute("COMMIT")
+        docs = []
+        for row in rows:
+            doc = dict(row)
+            doc["payload"] = json.loads(doc["payload"])
+            docs.append(doc)
+        return docs
+
+    async def enqueue(self, uid: int, payload: dict) -> int:
+        return await asyncio.to_thread(self._enqueue, uid, payload)
+
+    async def claim(self, worker: str, lease: float):
+        return await asyncio.to_thread(self._claim, worker, lease)
+
+    async def heartbeat(self, job_id: int, worker: str, lease: float, stage: str = None):
+        """Extends the lease. Returns (still_owned, cancel_requested)."""
+        return await asyncio.to_thread(self._heartbeat, job_id, worker, lease, stage)
+
+    async def complete(self, job_id: int, worker: str, state: str, error: str = None, unused_slots: list = None):
+        await asyncio.to_thread(self._complete, job_id, worker, state, error, unused_slots)
+
+    async def take_unused_slots(self) -> list:
+        """(uid, caption slots) that finished or cancelled jobs never used; each is returned once."""
+        return await asyncio.to_thread(self._take_unused_slots)
+
+    async def request_cancel(self, uid: int) -> int:
+        return await asyncio.to_thread(self._request_cancel, uid)
+
+    async def unfinished_before(self, uid: int, job_id: int) -> int:
+        return await asyncio.to_thread(self._unfinished_before, uid, job_id)
+
+    async def active(self) -> list:
+        return await asyncio.to_thread(self._active)
+
+    async def take_unnotified(self) -> list:
+        """Finished jobs nobody reported yet (a worker died with them); each is returned once."""
+        return await asyncio.to_thread(self._take_unnotified)
+
+class MongoJobQueue:
+    """The same queue in MongoDB via motor, for workers spread over several nodes."""
+
+    def __init__(self, uri: str):
+        from motor.motor_asyncio import AsyncIOMotorClient
+        db = AsyncIOMotorClient(uri)[os.getenv("QUEUE_DB", "urlbot")]
+        self.jobs = db.jobs
+        self.counters = db.counters
+
+    async def enqueue(self, uid: int, payload: dict) -> int:
+        from pymongo import ReturnDocument
+        counter = await self.counters.find_one_and_update({"_id": "jobs"}, {"$inc": {"seq": 1}}, upsert=True, return_document=ReturnDocument.AFTER)
+        now = time.time()
+        await self.jobs.insert_one({
+            "_id": counter["seq"], "uid": uid, "payload": payload, "state": "queued", "worker": None,
+            "lease_until": 0, "attempts": 0, "stage": None, "cancel": False, "error": None, "notified": False, "created": now, "updated": now,
+        })
+        return counter["seq"]
+
+    async def claim(self, worker: str, lease: float):
+        from pymongo import ReturnDocument
+        now = time.time()
+        await self.jobs.update_many(
+            {"state": "running", "lease_until": {"$lt": now}, "attempts": {"$gte": QUEUE_MAX_ATTEMPTS}},
+            {"$set": {"state": "failed", "error": "worker lost", "updated": now}}
+        )
+        doc = await self.jobs.find_one_and_update(
+            {"$or": [{"state": "queued"}, {"state": "running", "lease_until": {"$lt": now}}]},
+            {"$set": {"state": "running", "worker": worker, "lease_until": now + lease, "stage": None, "updated": now}, "$inc": {"attempts": 1}},
+            sort=[("_id", 1)], return_document=ReturnDocument.AFTER
+        )
+        if doc:
+            doc["id"] = doc.pop("_id")
+        return doc
+
+    async def heartbeat(self, job_id: int, worker: str, lease: float, stage: str = None):
+        now = time.time()
+        doc = await self.jobs.find_one_and_update(
+            {"_id": job_id, "worker": worker, "state": "running"},
+            {"$set": {"lease_until": now + lease, "stage": stage, "updated": now}},
+            projection={"cancel": 1}
+        )
+        if not doc:
+            return False, False
+        return True, bool(doc.get("cancel"))
+
+    async def complete(self, job_id: int, worker: str, state: str, error: str = None, unused_slots: list = None):
+        await self.jobs.update_one(
+            {"_id": job_id, "worker": worker, "state": "running"},
+            {"$set": {"state": state, "error": error, "unused_slots": unused_slots or None, "notified": True, "updated": time.time()}}
+        )
+
+    async def take_unused_slots(self) -> list:
+        taken = []
+        while True:
+            doc = await self.jobs.find_one_and_update({"unused_slots": {"$ne": None}}, {"$set": {"unused_slots": None}})
+            if not doc:
+                return taken
+            taken.append((doc["uid"], doc["unused_slots"]))
+
+    async def request_cancel(self, uid: int) -> int:
+        now = time.time()
+        queued = 0
+        async for doc in self.jobs.find({"uid": uid, "state": "queued"}, projection={"payload.caption_slots": 1}):
+            result = await self.jobs.update_one(
+                {"_id": doc["_id"], "state": "queued"},
+                {"$set": {"state": "cancelled", "unused_slots": doc["payload"].get("caption_slots") or None, "notified": True, "updated": now}}
+            )
+            queued += result.modified_count
+        running = await self.jobs.update_many({"uid": uid, "state": "running"}, {"$set": {"cancel": True, "updated": now}})
+        return queued + running.modified_count
+
+    async def unfinished_before(self, uid: int, job_id: int) -> int:
+        return await self.jobs.count_documents({"uid": uid, "_id": {"$lt": job_id}, "state": {"$in": ["queued", "running"]}})
+
+    async def active(self) -> list:
+        docs = []
+        async for doc in self.jobs.find({"state": {"$in": ["queued", "running"]}}).sort("_id", 1):
+            doc["id"] = doc.pop("_id")
+            docs.append(doc)
+        return docs
+
+    async def take_unnotified(self) -> list:
+        docs = []
+        while True:
+            doc = await self.jobs.find_one_and_update(
+                {"notified": False, "state": {"$in": ["done", "failed", "cancelled"]}},
+                {"$set": {"notified": True}}
+            )
+            if not doc:
+                return docs
+            doc["id"] = doc.pop("_id")
+            docs.append(doc)
+
+def build_job_queue():
+    if ROLE == "all":
+        return None
+    mongo_uri = os.getenv("MONGO_URI")
+    if mongo_uri:
+        return MongoJobQueue(mongo_uri)
+    return SqliteJobQueue(Path(os.getenv("QUEUE_SQLITE", str(DATA_DIR / "jobs.sqlite"))))
+
+JOB_QUEUE = build_job_queue()
+
+def live_settings(uid: int) -> dict:
+    return {
+        "caption": USER_CAPTIONS.get(uid),
+        "thumb_time": USER_THUMB_TIME.get(uid),
+        "rendition": uid in RENDITION_MODE,
+        "contact_sheet": uid in CONTACT_SHEET_MODE,
+        "targets": USER_TARGETS.get(uid),
+        "dupcheck": USER_DUP_MODE.get(uid),
+        "target_size": USER_TARGET_SIZE.get(uid),
+        "ordered": uid in ORDERED_DELIVERY,
+    }
+
+async def user_settings_snapshot(uid: int) -> dict:
+    """Everything a worker needs to process a job exactly as this process would."""
+    settings = live_settings(uid)
+    thumb = await get_user_thumb(uid)
+    settings["thumb"] = base64.b64encode(thumb).decode() if thumb else None
+    return settings
+
+def job_settings(job: dict) -> dict:
+    """The settings a job runs with: the snapshot it was queued with on a worker, else the user's live ones.
+
+    Worker jobs never take settings from the worker's per-user globals, so two
+    queued jobs of the same user can't see each other's settings.
+    """
+    if job.get("settings") is not None:
+        return job["settings"]
+    return live_settings(job["uid"])
+
+async def job_thumb(job: dict):
+    if job.get("settings") is not None:
+        return job["settings"]["thumb"]
+    return await get_user_thumb(job["uid"])
+
+async def dispatch_job(c: Client, m: Message, kind: str, **args):
+    """Runs a download/convert/upload job in this process, or queues it for a worker when ROLE is front."""
+    uid = m.from_user.id
+    # caption numbers follow the order jobs were sent in, not the order they finish converting
+    slots = reserve_caption_slots(uid, caption_slot_count(uid))
+    if ROLE != "front":
+        seq = open_submission(uid)
+        ctx = {"caption_slots": slots, "seq": seq}
+        token = JOB_CONTEXT.set(ctx)
+        try:
+            await JOB_RUNNERS[kind](c, m, **args)
+        finally:
+            JOB_CONTEXT.reset(token)
+            close_submission(uid, seq)
+            job = ctx.get("job")
+            release_caption_slots(uid, job["caption_slots"] if job else slots)
+        return
+    payload = {
+        "kind": kind,
+        "chat_id": m.chat.id,
+        "message_id": m.id,
+        "args": args,
+        "caption_slots": slots,
+        "settings": await user_settings_snapshot(uid),
+    }
+    # the worker adopts this message as the job's status message instead of posting another
+    notice = await m.reply_text("জব কিউতে যোগ হয়েছে, একটি worker এটি শুরু করবে। (/queue)", reply_markup=progress_keyboard())
+    payload["status_message_id"] = notice.id
+    await JOB_QUEUE.enqueue(uid, payload)
+
+async def queue_heartbeat(job_id: int, holder: dict):
+    while True:
+        await asyncio.sleep(QUEUE_LEASE / 3)
+        job = holder.get("job")
+        try:
+            owned, cancel = await JOB_QUEUE.heartbeat(job_id, WORKER_ID, QUEUE_LEASE, job.get("stage") if job else "starting")
+        except Exception as e:
+            logger.warning("Heartbeat for job #%s failed: %s", job_id, e)
+            continue
+        if job and (cancel or not owned) and not job["cancel"].is_set():
+            # a lost lease means another worker already took the job over
+            logger.info("Stopping job #%s (%s)", job_id, "cancelled" if cancel else "lease lost")
+            job.setdefault("cancelled_at", time.monotonic())
+            job["cancel"].set()
+
+async def run_queued_job(doc: dict, slots: asyncio.Semaphore):
+    payload = doc["payload"]
+    settings = payload["settings"]
+    # decoded once here; the job hands these bytes to every upload
+    settings["thumb"] = base64.b64decode(settings["thumb"]) if settings["thumb"] else None
+    holder = {
+        "caption_slots": payload.get("caption_slots", []),
+        "queue_id": doc["id"],
+        "status_message_id": payload.get("status_message_id"),
+        "settings": settings,
+    }
+    JOB_CONTEXT.set(holder)
+    heartbeat = asyncio.create_task(queue_heartbeat(doc["id"], holder))
+    state, error = "done", None
+    try:
+        m = await app.get_messages(payload["chat_id"], payload["message_id"])
+        if not m or m.empty:
+            raise Exception("job message not found")
+        await JOB_RUNNERS[payload["kind"]](app, m, **payload["args"])
+        job = holder.get("job")
+        if job and job["cancel"].is_set():
+            state = "cancelled"
+        elif job and job.get("error"):
+            state, error = "failed", job["error"]
+    except Exception as e:
+        logger.exception("Queued job #%s failed", doc["id"])
+        state, error = "failed", str(e)
+    finally:
+        heartbeat.cancel()
+        job = holder.get("job")
+        unused = job["caption_slots"] if job else holder["caption_slots"]
+        try:
+            await JOB_QUEUE.complete(doc["id"], WORKER_ID, state, error, unused)
+        except Exception as e:
+            logger.warning("Could not complete job #%s: %s", doc["id"], e)
+        slots.release()
+
+async def run_worker():
+    """Pulls jobs from the shared queue, WORKER_CONCURRENCY at a time."""
+    logger.info("Worker %s polling the job queue", WORKER_ID)
+    slots = asyncio.Semaphore(WORKER_CONCURRENCY)
+    while True:
+        await slots.acquire()
+        try:
+            doc = await JOB_QUEUE.claim(WORKER_ID, QUEUE_LEASE)
+        except Exception as e:
+            logger.warning("Job queue poll failed: %s", e)
+            doc = None
+        if not doc:
+            slots.release()
+            await asyncio.sleep(QUEUE_POLL_INTERVAL)
+            continue
+        logger.info("Worker %s took job #%s (attempt %s)", WORKER_ID, doc["id"], doc["attempts"])
+        asyncio.create_task(run_queued_job(doc, slots))
+
+async def watch_queue_results():
+    """Front side: takes back unused caption slots and tells users about jobs their worker died with."""
+    while True:
+        try:
+            for uid, unused in await JOB_QUEUE.take_unused_slots():
+                release_caption_slots(uid, unused)
+            for doc in await JOB_QUEUE.take_unnotified():
+                # a dead worker may have posted some of its numbers already, so they stay used
+                payload = doc["payload"]
+                await app.send_message(
+                    payload["chat_id"],
+                    f"জব #{doc['id']} ব্যর্থ: {doc.get('error') or doc['state']} ({doc['attempts']} বার চেষ্টা করা হয়েছে)",
+                    reply_to_message_id=payload["message_id"]
+                )
+        except Exception as e:
+            logger.warning("Queue result watch failed: %s", e)
+        await asyncio.sleep(QUEUE_POLL_INTERVAL * 5)
+
+JOB_RUNNERS = {
+    "url": handle_url_download_and_upload,
+    "forward": run_forwarded_upload,
+    "rename": run_rename,
+}
+
+@app.on_message(filters.command("queue") & filters.private)
+async def queue_cmd(c, m: Message):
+    if not is_admin(m.from_user.id):
+        await m.reply_text("আপনার অনুমতি নেই এই কমান্ড চালানোর।")
+        return
+    if JOB_QUEUE is None:
+        await m.reply_text("বট ROLE=all মোডে চলছে, কোনো শেয়ার্ড কিউ নেই।")
+        return
+    docs = await JOB_QUEUE.active()
+    if not docs:
+        await m.reply_text("কিউ খালি।")
+        return
+    lines = [f"কিউতে {len(docs)} টি জব:"]
+    now = time.time()
+    for doc in docs[:30]:
+        if doc["state"] == "running":
+            lines.append(f"#{doc['id']} running on {doc['worker']} ({doc.get('stage') or 'starting'}, attempt {doc['attempts']})")
+        else:
+            lines.append(f"#{doc['id']} queued {now - doc['created']:.0f}s")
+    await m.reply_text("\n".join(lines))
+
 # ---- main processing and upload ----
-async def generate_video_thumbnail(video_path: Path, thumb_path: Path, timestamp_sec: int = 1):
+def preview_timestamps(duration: int, count: int, user_time: int = None) -> list:
+    """Spreads `count` seek points over the video, skipping the intro/outro edges."""
+    stamps = []
+    if user_time is not None:
+        stamps.append(float(user_time))
+    if duration > 0:
+        start, end = duration * 0.05, duration * 0.95
+        step = (end - start) / count
+        stamps += [start + step * (i + 0.5) for i in range(count)]
+    elif user_time is None:
+        stamps.append(1.0)
+    return stamps
+
+async def extract_preview_frames(video_path, timestamps: list, width: int = 320, cancel_event: asyncio.Event = None) -> list:
+    """Grabs one frame per timestamp in a single ffmpeg run using input seeking, so only the needed GOPs are decoded.
+
+    `video_path` may also be an HTTP URL; ffmpeg then seeks with range requests.
+    The result lines up with `timestamps`, with None for every frame that failed.
+    """
+    stem = re.sub(r"\W", "_", Path(str(video_path).split("?")[0]).stem)[:40]
+    prefix = TMP / f"preview_{stem}_{time.time_ns()}"
+    frames = [Path(f"{prefix}_{i}.jpg") for i in range(len(timestamps))]
+    cmd = ["ffmpeg", "-y", "-v", "error"]
+    for ts in timestamps:
+        cmd += ["-ss", f"{ts:.2f}", "-i", str(video_path)]
+    for i, frame in enumerate(frames):
+        cmd += ["-map", f"{i}:v:0", "-frames:v", "1", "-vf", f"scale={width}:-2", str(frame)]
+    returncode, stderr = await run_ffmpeg(cmd, timeout=PREVIEW_TIMEOUT, cancel_event=cancel_event)
+    if returncode != 0:
+        logger.warning("Preview extraction failed: %s", stderr[-500:])
+    return [f if f.exists() and f.stat().st_size > 0 else None for f in frames]
+
+def score_preview_frames(frames: list) -> list:
+    """Scores frames by grey-level entropy, penalising near-black and blown-out frames."""
+    scores = []
+    for frame in frames:
+        with Image.open(frame) as img:
+            gray = np.asarray(img.convert("L"), dtype=np.uint8)
+        brightness = gray.mean()
+        hist = np.bincount(gray.ravel(), minlength=256) / gray.size
+        hist = hist[hist > 0]
+        entropy = float(-(hist * np.log2(hist)).sum())
+        exposure = 1.0 - abs(brightness - 128.0) / 128.0
+        score = entropy * (0.5 + 0.5 * exposure)
+        if brightness < 20 or brightness > 235:
+            score *= 0.1
+        scores.append(score)
+    return scores
+
+def build_contact_sheet(frames: list, sheet_path: Path, columns: int = 4):
+    tiles = [Image.open(f).convert("RGB") for f in frames]
     try:
-        cmd = [
-            "ffmpeg",
-            "-y",
-            "-i", str(video_path),
-            "-ss", str(timestamp_sec),
-            "-vframes", "1",
-            "-vf", "scale=320:-1",
-            str(thumb_path)
-        ]
-        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        tile_w = max(t.width for t in tiles)
+        tile_h = max(t.height for t in tiles)
+        rows = math.ceil(len(tiles) / columns)
+        sheet = Image.new("RGB", (tile_w * min(columns, len(tiles)), tile_h * rows))
+        for i, tile in enumerate(tiles):
+            sheet.paste(tile, ((i % columns) * tile_w, (i // columns) * tile_h))
+        sheet.save(sheet_path, "JPEG", quality=85)
+    finally:
+        for t in tiles:
+            t.close()
+
+def pick_preview_frame(frames: list, thumb_path: Path, sheet_path: Path = None, prefer_first: bool = False):
+    present = [f for f in frames if f is not None]
+    scores = score_preview_frames(present)
+    best = int(np.argmax(scores))
+    # frames[0] is the user's chosen time; keep it unless it is missing or clearly worse (e.g. a black frame)
+    if prefer_first and frames[0] is not None and scores[0] >= 0.8 * scores[best]:
+        best = 0
+    with Image.open(present[best]) as img:
+        img.convert("RGB").save(thumb_path, "JPEG")
+    if sheet_path:
+        build_contact_sheet(present, sheet_path)
+
+async def generate_video_thumbnail(video_path: Path, thumb_path: Path, timestamp_sec: int = None, sheet_path: Path = None, cancel_event: asyncio.Event = None):
+    """Samples several frames in one pass and keeps the most detailed one as the thumbnail."""
+    frames = []
+    try:
+        duration = await asyncio.to_thread(get_video_duration, video_path)
+        timestamps = preview_timestamps(duration, PREVIEW_FRAMES, timestamp_sec)
+        frames = await extract_preview_frames(video_path, timestamps, cancel_event=cancel_event)
+        if not any(frames):
+            return False
+        await asyncio.to_thread(pick_preview_frame, frames, thumb_path, sheet_path, timestamp_sec is not None)
         return thumb_path.exists() and thumb_path.stat().st_size > 0
     except Exception as e:
         logger.warning("Thumbnail generate error: %s", e)
         return False
+    finally:
+        for f in frames:
+            if f is None:
+                continue
+            try:
+                f.unlink()
+            except Exception:
+                pass
 
-async def convert_to_mkv(in_path: Path, out_path: Path, status_msg: Message):
+async def run_ffmpeg(cmd: list, timeout: int = 3600, cancel_event: asyncio.Event = None):
+    """Runs an ffmpeg command without blocking the event loop and returns (returncode, stderr).
+
+    The child is killed as soon as `cancel_event` is set or the timeout expires.
+    """
+    proc = await asyncio.create_subprocess_exec(*cmd, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    communicate = asyncio.ensure_future(proc.communicate())
+    waiters = {communicate}
+    cancel_wait = asyncio.ensure_future(cancel_event.wait()) if cancel_event else None
+    if cancel_wait:
+        waiters.add(cancel_wait)
+    try:
+        done, _ = await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        if cancel_wait:
+            cancel_wait.cancel()
+    if communicate not in done:
+        proc.kill()
+        await communicate
+        if cancel_event and cancel_event.is_set():
+            return -1, "ffmpeg cancelled"
+        return -1, f"ffmpeg timed out after {timeout}s"
+    _, stderr = communicate.result()
+    return proc.returncode, stderr.decode(errors="ignore")
+
+def rendition_labels(caption_template: str = None) -> list:
+    """Returns the quality labels of the caption's [re (...)] code, or the default set."""
+    if caption_template:
+        quality_match = re.search(r"\[re\s*\(.*?\)\]", caption_template)
+        if quality_match:
+            options_str = quality_match.group(0)
+            options_list_str = options_str[options_str.find("(") + 1:options_str.rfind(")")]
+            options = [opt.strip().strip("()") for opt in options_list_str.split(',')]
+            if options and all(re.fullmatch(r"\d+p", opt) for opt in options):
+                return options
+    return list(DEFAULT_RENDITIONS)
+
+async def encode_renditions(in_path: Path, labels: list, cancel_event: asyncio.Event = None):
+    """Decodes the source once and encodes every label (e.g. 720p) in a single ffmpeg run via the split filter."""
+    heights = [int(label[:-1]) for label in labels]
+    outputs = [TMP / f"{in_path.stem}_{label}.mkv" for label in labels]
+    split_outs = "".join(f"[s{i}]" for i in range(len(labels)))
+    graph = [f"[0:v:0]split={len(labels)}{split_outs}"]
+    for i, h in enumerate(heights):
+        # never upscale: a 720p source stays 720p in the 1080p slot
+        graph.append(f"[s{i}]scale=-2:'min({h},ih)'[v{i}]")
+    cmd = ["ffmpeg", "-y", "-i", str(in_path), "-filter_complex", ";".join(graph)]
+    for i, out in enumerate(outputs):
+        cmd += [
+            "-map", f"[v{i}]",
+            "-map", "0:a?",
+            "-c:v", "libx264",
+            "-preset", RENDITION_PRESET,
+            "-crf", "23",
+            "-c:a", "copy",
+            str(out)
+        ]
+    returncode, stderr = await run_ffmpeg(cmd, timeout=3 * 3600, cancel_event=cancel_event)
+    if returncode != 0:
+        for out in outputs:
+            if out.exists():
+                out.unlink()
+        raise Exception(f"Rendition encoding failed: {stderr[-1000:]}")
+    return outputs
+
+async def convert_to_mkv(in_path: Path, out_path: Path, status: StatusMessage, cancel_event: asyncio.Event = None):
     try:
-        try:
-            await status_msg.edit("ভিডিওটি MKV ফরম্যাটে কনভার্ট করা হচ্ছে...", reply_markup=progress_keyboard())
-        except Exception:
-            await m.reply_text("ভিডিওটি MKV ফরম্যাটে কনভার্ট করা হচ্ছে...", reply_markup=progress_keyboard())
         cmd = [
             "ffmpeg",
+            "-y",
             "-i", str(in_path),
             "-codec", "copy",
             str(out_path)
         ]
         
-        result = subprocess.run(cmd, capture_output=True, text=True, check=False, timeout=1200)
+        returncode, stderr = await run_ffmpeg(cmd, timeout=1200, cancel_event=cancel_event)
+        if cancel_event and cancel_event.is_set():
+            raise Exception("অপারেশন ব্যবহারকারী দ্বারা বাতিল করা হয়েছে।")
         
-        if result.returncode != 0:
-            logger.warning("Container conversion failed, attempting full re-encoding: %s", result.stderr)
-            try:
-                await status_msg.edit("ভিডিওটি MKV ফরম্যাটে পুনরায় এনকোড করা হচ্ছে...", reply_markup=progress_keyboard())
-            except Exception:
-                await m.reply_text("ভিডিওটি MKV ফরম্যাটে পুনরায় এনকোড করা হচ্ছে...", reply_markup=progress_keyboard())
+        if returncode != 0:
+            logger.warning("Container conversion failed, attempting full re-encoding: %s", stderr)
+            await status.update("ভিডিওটি MKV ফরম্যাটে পুনরায় এনকোড করা হচ্ছে...")
             cmd_full = [
                 "ffmpeg",
+                "-y",
                 "-i", str(in_path),
                 "-c:v", "libx264",
                 "-preset", "fast",
@@ -746,9 +2582,9 @@ async def convert_to_mkv(in_path: Path, out_path: Path, status_msg: Message):
                 "-c:a", "copy",
                 str(out_path)
             ]
-            result_full = subprocess.run(cmd_full, capture_output=True, text=True, check=False, timeout=3600)
-            if result_full.returncode != 0:
-                raise Exception(f"Full re-encoding failed: {result_full.stderr}")
+            returncode, stderr = await run_ffmpeg(cmd_full, timeout=3600, cancel_event=cancel_event)
+            if returncode != 0:
+                raise Exception(f"Full re-encoding failed: {stderr}")
 
         if not out_path.exists() or out_path.stat().st_size == 0:
             raise Exception("Converted file not found or is empty.")
@@ -756,15 +2592,69 @@ async def convert_to_mkv(in_path: Path, out_path: Path, status_msg: Message):
         return True, None
     except Exception as e:
         logger.error("Video conversion error: %s", e)
+        if out_path.exists():
+            out_path.unlink()
         return False, str(e)
 
-def process_dynamic_caption(uid, caption_template):
+def target_bitrates(target_bytes: int, duration: float) -> tuple:
+    """Splits a size budget into (video_kbps, audio_kbps), keeping a margin for container overhead."""
+    total_kbps = target_bytes * 8 / 1000 * TARGET_SIZE_MARGIN / duration
+    audio_kbps = min(TARGET_AUDIO_KBPS, total_kbps * 0.2)
+    return int(total_kbps - audio_kbps), int(audio_kbps)
+
+async def encode_to_target_size(in_path: Path, out_path: Path, target_bytes: int, duration: float, preset: str = None, cancel_event: asyncio.Event = None):
+    """Two-pass libx264 encode sized to `target_bytes`. Returns (ok, error, speed) where speed is x realtime."""
+    video_kbps, audio_kbps = target_bitrates(target_bytes, duration)
+    if video_kbps < TARGET_MIN_VIDEO_KBPS:
+        return False, f"{human_size(target_bytes)} এ {int(duration)}s ভিডিও রাখতে বিটরেট খুব কম ({video_kbps} kbps)", 0
+    passlog = TMP / f"2pass_{in_path.stem}_{time.time_ns()}"
+    common = [
+        "-c:v", "libx264",
+        "-preset", preset or TARGET_PRESET,
+        "-b:v", f"{video_kbps}k",
+        # cap peaks so a static first half can't starve an action-heavy ending
+        "-maxrate", f"{int(video_kbps * 1.5)}k",
+        "-bufsize", f"{video_kbps * 2}k",
+        "-threads", str(ENCODE_THREADS),
+        "-passlogfile", str(passlog),
+    ]
+    start = time.monotonic()
+    try:
+        returncode, stderr = await run_ffmpeg(
+            ["ffmpeg", "-y", "-i", str(in_path), *common, "-pass", "1", "-an", "-f", "null", os.devnull],
+            timeout=3 * 3600, cancel_event=cancel_event
+        )
+        if returncode == 0:
+            returncode, stderr = await run_ffmpeg(
+                ["ffmpeg", "-y", "-i", str(in_path), *common, "-pass", "2",
+                 "-map", "0:v:0", "-map", "0:a?", "-c:a", "aac", "-b:a", f"{audio_kbps}k",
+                 "-movflags", "+faststart", str(out_path)],
+                timeout=3 * 3600, cancel_event=cancel_event
+            )
+    finally:
+        for log in TMP.glob(f"{passlog.name}*"):
+            try:
+                log.unlink()
+            except Exception:
+                pass
+    if returncode != 0 or not out_path.exists():
+        if out_path.exists():
+            out_path.unlink()
+        return False, f"Target-size encoding failed: {stderr[-1000:]}", 0
+    speed = duration / max(time.monotonic() - start, 0.001)
+    logger.info("Encoded %s to %s (target %s) at %.2fx realtime", in_path.name, human_size(out_path.stat().st_size), human_size(target_bytes), speed)
+    return True, None, speed
+
+def process_dynamic_caption(uid, caption_template, upload_index: int = None):
     # Initialize user state if it doesn't exist
     if uid not in USER_COUNTERS:
         USER_COUNTERS[uid] = {'uploads': 0, 'episode_numbers': {}}
 
-    # Increment upload counter for the current user
-    USER_COUNTERS[uid]['uploads'] += 1
+    # Increment upload counter for the current user, unless the sequencer
+    # already reserved this upload's value at submission time
+    if upload_index is None:
+        USER_COUNTERS[uid]['uploads'] += 1
+        upload_index = USER_COUNTERS[uid]['uploads']
 
     # Episode Number Logic (e.g., [(01) (+1, 3u)])
     episode_matches = re.findall(r"\[\((\d+)\) \(\+(\d+), (\d+)u\)\]", caption_template)
@@ -780,7 +2670,7 @@ def process_dynamic_caption(uid, caption_template):
             USER_COUNTERS[uid]['episode_numbers'][code_key] = start_num
         
         # Calculate the current episode number
-        current_uploads = USER_COUNTERS[uid]['uploads']
+        current_uploads = upload_index
         episode_number = start_num + ((current_uploads - 1) // uploads_per_inc) * increment_val
         
         # Format the number with leading zeros if necessary
@@ -800,7 +2690,7 @@ def process_dynamic_caption(uid, caption_template):
         if code_key not in USER_COUNTERS[uid]['episode_numbers']:
             USER_COUNTERS[uid]['episode_numbers'][code_key] = start_num
         
-        current_uploads = USER_COUNTERS[uid]['uploads']
+        current_uploads = upload_index
         episode_number = start_num + ((current_uploads - 1) // uploads_per_inc) * increment_val
         
         formatted_episode_number = f"{episode_number:02d}"
@@ -815,7 +2705,7 @@ def process_dynamic_caption(uid, caption_template):
         options_list_str = options_str[options_str.find("(") + 1:options_str.rfind(")")]
         options = [opt.strip().strip("()") for opt in options_list_str.split(',')]
         
-        current_index = (USER_COUNTERS[uid]['uploads'] - 1) % len(options)
+        current_index = (upload_index - 1) % len(options)
         current_quality = options[current_index]
         
         caption_template = caption_template.replace(quality_match.group(0), current_quality)
@@ -828,7 +2718,7 @@ def process_dynamic_caption(uid, caption_template):
         end_episode_num = int(end_episode_num_str) if end_episode_num_str else 0
         repeat_count = int(match[1])
 
-        current_uploads = USER_COUNTERS[uid]['uploads']
+        current_uploads = upload_index
 
         if current_uploads >= end_episode_num and current_uploads < end_episode_num + repeat_count:
             caption_template = caption_template.replace(end_placeholder, "End")
@@ -838,114 +2728,671 @@ def process_dynamic_caption(uid, caption_template):
     return "**" + "\n".join(caption_template.splitlines()) + "**"
 
 
-async def process_file_and_upload(c: Client, m: Message, in_path: Path, original_name: str = None, messages_to_delete: list = None):
+async def upload_with_retries(c: Client, m: Message, upload_path: Path, is_video: bool, caption: str, final_name: str, thumb=None, duration_sec: int = 0, cancel_event: asyncio.Event = None, upload_attempts: int = 3, job: dict = None):
+    """Uploads one file to the job's chat through the client pool, retrying with backoff. Returns (sent_message, last_exception)."""
+    last_exc = None
+    sent = None
+    progress_state = {"sent": 0}
+    await wait_for_memory(job, "upload")
+    with trace_span(job, "upload", upload_path.stat().st_size if upload_path.exists() else 0), reserve_buffer(job, UPLOAD_BUFFER_ESTIMATE):
+        for attempt in range(1, upload_attempts + 1):
+            if cancel_event and cancel_event.is_set():
+                return None, None
+            try:
+                async with lease_client() as cl:
+                    # pool helpers upload into the relay chat and the bot copies from there
+                    chat_id = m.chat.id if cl is c else POOL_RELAY_CHAT
+                    if is_video:
+                        sent = await cl.send_video(
+                            chat_id=chat_id,
+                            video=str(upload_path),
+                            caption=caption_for_chat(caption, ""),
+                            thumb=thumb_file(thumb),
+                            duration=duration_sec,
+                            supports_streaming=True,
+                            parse_mode=ParseMode.MARKDOWN,
+                            progress=upload_progress,
+                            progress_args=(job, progress_state, cancel_event)
+                        )
+                    else:
+                        sent = await cl.send_document(
+                            chat_id=chat_id,
+                            document=str(upload_path),
+                            file_name=final_name,
+                            caption=caption_for_chat(caption, ""),
+                            parse_mode=ParseMode.MARKDOWN,
+                            progress=upload_progress,
+                            progress_args=(job, progress_state, cancel_event)
+                        )
+                if sent is None:
+                    # stop_transmission from upload_progress: the job was cancelled
+                    return None, None
+                break
+            except FloodWait as e:
+                # lease_client already benched that session; the next attempt picks another
+                last_exc = e
+                logger.warning("Upload attempt %s hit FloodWait: %s", attempt, e)
+                if cancel_event and cancel_event.is_set():
+                    break
+                # with every session benched, retrying now would just hit the same wait
+                wait = min(CLIENT_FLOOD_UNTIL.get(cl.name, 0) for cl in pool_clients()) - time.monotonic()
+                if wait > 0 and attempt < upload_attempts:
+                    logger.info("All clients are flood-waited, sleeping %.0fs before retrying", wait)
+                    try:
+                        await asyncio.wait_for((cancel_event or asyncio.Event()).wait(), timeout=wait)
+                        break
+                    except asyncio.TimeoutError:
+                        pass
+            except Exception as e:
+                last_exc = e
+                logger.warning("Upload attempt %s failed: %s", attempt, e)
+                await asyncio.sleep(2 * attempt)
+                if cancel_event and cancel_event.is_set():
+                    break
+        if cancel_event and cancel_event.is_set():
+            return None, None
+        if sent is None:
+            return None, last_exc
+    if chat_id != m.chat.id:
+        # the file is already on Telegram; a failed copy is retried on its own
+        # instead of uploading the whole file again
+        try:
+            sent = await copy_from_relay(c, m.chat.id, sent)
+        except Exception as e:
+            logger.warning("Copy from relay chat failed: %s", e)
+            return None, e
+    if job is not None:
+        job["sent"].append((sent, caption))
+    return sent, None
+
+async def copy_from_relay(c: Client, chat_id: int, relayed: Message, attempts: int = 3) -> Message:
+    """Copies a pool helper's upload from the relay chat into chat_id, then deletes the relay copy."""
+    last_exc = None
+    try:
+        for attempt in range(1, attempts + 1):
+            try:
+                async with lease_client(c):
+                    return await c.copy_message(chat_id, POOL_RELAY_CHAT, relayed.id)
+            except FloodWait as e:
+                last_exc = e
+                if attempt < attempts:
+                    await asyncio.sleep(e.value)
+            except Exception as e:
+                last_exc = e
+                if attempt < attempts:
+                    await asyncio.sleep(2 * attempt)
+        raise last_exc
+    finally:
+        try:
+            await c.delete_messages(POOL_RELAY_CHAT, relayed.id)
+        except Exception:
+            pass
+
+async def upload_renditions(c: Client, m: Message, in_path: Path, final_name: str, caption_template: str, thumb, cancel_event: asyncio.Event, job: dict = None):
+    """Encodes every quality label from one source and uploads the outputs in parallel."""
     uid = m.from_user.id
-    cancel_event = asyncio.Event()
-    TASKS.setdefault(uid, []).append(cancel_event)
+    labels = rendition_labels(caption_template)
+    await wait_for_memory(job, "encode")
+    with trace_span(job, "encode", in_path.stat().st_size):
+        outputs = await encode_renditions(in_path, labels, cancel_event)
+    try:
+        # captions are rendered in label order so the upload counter advances
+        # exactly as it would for separately uploaded files
+        captions = []
+        for label in labels:
+            template = re.sub(r"\[re\s*\(.*?\)\]", label, caption_template, count=1) if caption_template else None
+            captions.append(job_caption(uid, template, job, f"{Path(final_name).stem} [{label}]"))
+        with trace_span(job, "probe"):
+            durations = [await asyncio.to_thread(get_video_duration, out) for out in outputs]
+        results = await asyncio.gather(*[
+            upload_with_retries(
+                c, m, out, True, caption, out.name,
+                thumb=thumb,
+                duration_sec=duration,
+                cancel_event=cancel_event,
+                job=job
+            )
+            for out, caption, duration in zip(outputs, captions, durations)
+        ])
+        errors = [exc for _, exc in results if exc]
+        return errors[0] if errors else None
+    finally:
+        for out in outputs:
+            try:
+                if out.exists():
+                    out.unlink()
+            except Exception:
+                pass
+
+async def split_video_parts(path: Path, duration: int, limit: int, cancel_event: asyncio.Event = None):
+    """Cuts a video into self-contained stream-copy segments at keyframes and yields each one as soon as ffmpeg closes it."""
+    size = path.stat().st_size
+    # aim below the limit: segments only cut on keyframes, so they run long
+    seg_time = max(10, int(duration * (limit * 0.85) / size))
+    # never the user's file name: a "%" in it would break ffmpeg's output pattern
+    stem = f"segments_{time.time_ns()}"
+    list_path = TMP / f"{stem}_parts.csv"
+    pattern = TMP / f"{stem}_part%03d{path.suffix}"
+    cmd = [
+        "ffmpeg", "-y", "-v", "error",
+        "-i", str(path),
+        "-map", "0:v", "-map", "0:a?",
+        "-c", "copy",
+        "-f", "segment",
+        "-segment_time", str(seg_time),
+        "-reset_timestamps", "1",
+        "-segment_list", str(list_path),
+        "-segment_list_type", "csv",
+        str(pattern)
+    ]
+    proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+    seen = 0
+    try:
+        while True:
+            finished = proc.returncode is not None
+            # ffmpeg appends a line to the list only after a segment is complete
+            text = list_path.read_text() if list_path.exists() else ""
+            rows = list(csv.reader(io.StringIO(text[:text.rfind("\n") + 1])))
+            for row in rows[seen:]:
+                seen += 1
+                yield TMP / row[0]
+            if finished or (cancel_event and cancel_event.is_set()):
+                break
+            await asyncio.sleep(1)
+        if proc.returncode is not None and proc.returncode != 0:
+            raise Exception(f"ffmpeg segmenting failed with code {proc.returncode}")
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        for leftover in TMP.glob(f"{stem}_part*"):
+            try:
+                leftover.unlink()
+            except Exception:
+                pass
+        if list_path.exists():
+            list_path.unlink()
+
+def _copy_part(src: Path, dst: Path, offset: int, length: int, hasher) -> int:
+    written = 0
+    with src.open("rb") as fin, dst.open("wb") as fout:
+        fin.seek(offset)
+        while written < length:
+            buf = fin.read(min(8 * 1024 * 1024, length - written))
+            if not buf:
+                break
+            if hasher:
+                hasher.update(buf)
+            fout.write(buf)
+            written += len(buf)
+    return written
+
+async def split_raw_parts(path: Path, limit: int, name: str, digest: str = None):
+    """Yields `name.001`, `name.002`, ... byte parts and finally a join manifest.
+
+    `digest` is the file's SHA-256 if the download already computed it; otherwise it
+    is hashed while the parts are copied. The parts live in a directory of their own
+    so two jobs splitting a file of the same name never share part paths.
+    """
+    size = path.stat().st_size
+    count = math.ceil(size / limit)
+    hasher = None if digest else hashlib.sha256()
+    workdir = TMP / f"parts_{time.time_ns()}"
+    workdir.mkdir(parents=True, exist_ok=True)
+    entries = []
+    try:
+        for i in range(count):
+            part = workdir / f"{name}.{i + 1:03d}"
+            written = await asyncio.to_thread(_copy_part, path, part, i * limit, limit, hasher)
+            entries.append(f"{part.name} {written}")
+            yield part
+        part_names = " ".join(e.split()[0] for e in entries)
+        manifest = workdir / f"{name}.manifest.txt"
+        manifest.write_text(
+            f"file: {name}\n"
+            f"size: {size}\n"
+            f"sha256: {digest or hasher.hexdigest()}\n"
+            f"parts:\n" + "\n".join(entries) + "\n"
+            f"join (Linux/macOS): cat {part_names} > \"{name}\"\n"
+            f"join (Windows): copy /b {'+'.join(e.split()[0] for e in entries)} \"{name}\"\n"
+        )
+        yield manifest
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+async def upload_split_parts(c: Client, m: Message, upload_path: Path, is_video: bool, final_name: str, caption: str, thumb=None, cancel_event: asyncio.Event = None, job: dict = None):
+    """Uploads a file larger than UPLOAD_LIMIT as playable video segments, or as raw parts plus a join manifest."""
+    duration = await asyncio.to_thread(get_video_duration, upload_path) if is_video else 0
+    if is_video and duration > 0:
+        parts = split_video_parts(upload_path, duration, UPLOAD_LIMIT, cancel_event)
+    else:
+        is_video = False
+        parts = split_raw_parts(upload_path, UPLOAD_LIMIT, final_name, digest=FILE_DIGESTS.get(str(upload_path)))
+    index = 0
+    try:
+        async for part in parts:
+            index += 1
+            try:
+                part_caption = f"{caption}\n\nPart {index}"
+                # segments are named on disk by timestamp; users see the file's own name
+                part_name = f"{Path(final_name).stem}_part{index:03d}{part.suffix}" if is_video else part.name
+                if is_video and part.stat().st_size > UPLOAD_LIMIT:
+                    # a very long GOP can push a segment over the limit
+                    exc = await upload_split_parts(c, m, part, False, part_name, part_caption, cancel_event=cancel_event, job=job)
+                elif is_video:
+                    _, exc = await upload_with_retries(
+                        c, m, part, True, part_caption, part_name,
+                        thumb=thumb,
+                        duration_sec=await asyncio.to_thread(get_video_duration, part),
+                        cancel_event=cancel_event,
+                        job=job
+                    )
+                else:
+                    _, exc = await upload_with_retries(c, m, part, False, part_caption, part.name, cancel_event=cancel_event, job=job)
+            finally:
+                if part.exists():
+                    part.unlink()
+            if exc:
+                return exc
+            if cancel_event and cancel_event.is_set():
+                return None
+    finally:
+        await parts.aclose()
+    return None
+
+def archive_kind(path: Path, name: str):
+    """Returns "zip" or "tar" for archives we expand, judged by name first so .apk/.docx stay whole."""
+    lower = name.lower()
+    try:
+        if lower.endswith(".zip") and zipfile.is_zipfile(path):
+            return "zip"
+        if lower.endswith(ARCHIVE_EXTS[1:]) and tarfile.is_tarfile(path):
+            return "tar"
+    except Exception:
+        return None
+    return None
+
+def _copy_member(src, dst: Path):
+    with dst.open("wb") as out:
+        shutil.copyfileobj(src, out, 1024 * 1024)
+
+def _zip_extract(zf, info, dst: Path):
+    with zf.open(info) as src:
+        _copy_member(src, dst)
+
+def _tar_next_file(tf):
+    while True:
+        member = tf.next()
+        if member is None or member.isfile():
+            return member
+
+def _tar_extract(tf, member, dst: Path):
+    src = tf.extractfile(member)
+    with src:
+        _copy_member(src, dst)
+
+async def iter_archive_members(archive_path: Path, kind: str, job: dict = None):
+    """Yields (member name, extracted path) one at a time; a member only hits
+    the disk right before it's needed. Tars are read as a forward-only stream."""
+    uid_stamp = time.time_ns()
+    if kind == "zip":
+        with zipfile.ZipFile(archive_path) as zf:
+            infos = sorted((i for i in zf.infolist() if not i.is_dir()), key=lambda i: i.filename.lower())
+            for index, info in enumerate(infos):
+                name = Path(info.filename).name
+                dst = TMP / f"arc_{uid_stamp}_{index}_{name}"
+                with trace_span(job, "extract", info.file_size):
+                    await asyncio.to_thread(_zip_extract, zf, info, dst)
+                yield name, dst
+    else:
+        with tarfile.open(archive_path, "r|*") as tf:
+            index = 0
+            while True:
+                member = await asyncio.to_thread(_tar_next_file, tf)
+                if member is None:
+                    break
+                name = Path(member.name).name
+                dst = TMP / f"arc_{uid_stamp}_{index}_{name}"
+                with trace_span(job, "extract", member.size):
+                    await asyncio.to_thread(_tar_extract, tf, member, dst)
+                index += 1
+                yield name, dst
+
+async def upload_archive_members(c: Client, m: Message, archive_path: Path, kind: str, job: dict):
+    """Sends every archive member through the normal upload path, one member on disk at a time."""
+    count = 0
+    members = iter_archive_members(archive_path, kind, job)
+    try:
+        async for name, member_path in members:
+            if job["cancel"].is_set():
+                member_path.unlink()
+                break
+            safe_name = re.sub(r"[\\/*?\"<>|:]", "_", name)
+            is_video = member_path.suffix.lower() in VIDEO_EXTS
+            # process_file_and_upload deletes the member once it is uploaded
+            await process_file_and_upload(c, m, member_path, original_name=safe_name, job=job, is_video=is_video, expand_archives=False)
+            count += 1
+    finally:
+        await members.aclose()
+    return count
+
+# ---- duplicate detection ----
+def _dct_matrix(n: int = 32) -> np.ndarray:
+    k = np.arange(n)
+    mat = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n)) * np.sqrt(2 / n)
+    mat[0] /= np.sqrt(2)
+    return mat
+
+PHASH_DCT = _dct_matrix()
+
+def phash_frames(frames: list) -> np.ndarray:
+    """64-bit DCT perceptual hash of every frame, computed as one batched matrix product."""
+    pixels = []
+    for frame in frames:
+        with Image.open(frame) as img:
+            pixels.append(np.asarray(img.convert("L").resize((32, 32), Image.BILINEAR), dtype=np.float32))
+    stack = np.stack(pixels)
+    low = (PHASH_DCT @ stack @ PHASH_DCT.T)[:, :8, :8].reshape(len(pixels), 64)
+    # median without the DC term, which only tracks overall brightness
+    bits = low > np.median(low[:, 1:], axis=1, keepdims=True)
+    return np.packbits(bits, axis=1).view(">u8").ravel()
+
+def fingerprint_timestamps(duration: float) -> list:
+    # fixed relative positions so two mirrors of the same video sample the same scenes
+    return [duration * p for p in (0.1, 0.3, 0.5, 0.7, 0.9)]
+
+async def probe_duration(source: str) -> float:
+    """Duration via ffprobe; works for URLs as well as local files."""
+    proc = await asyncio.create_subprocess_exec(
+        "ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", source,
+        stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+    )
+    try:
+        out, _ = await asyncio.wait_for(proc.communicate(), timeout=PREVIEW_TIMEOUT)
+        return float(out.decode().strip() or 0)
+    except (asyncio.TimeoutError, ValueError):
+        if proc.returncode is None:
+            proc.kill()
+        return 0.0
+
+async def video_fingerprint(source, duration: float = 0, cancel_event: asyncio.Event = None):
+    """Returns (hashes, duration) for a local video or a seekable URL, or (None, 0)."""
+    if not duration:
+        duration = await probe_duration(str(source))
+    if duration <= 0:
+        return None, 0
+    frames = await extract_preview_frames(source, fingerprint_timestamps(duration), width=64, cancel_event=cancel_event)
+    try:
+        if not all(frames):
+            return None, duration
+        return await asyncio.to_thread(phash_frames, frames), duration
+    finally:
+        for f in frames:
+            if f is None:
+                continue
+            try:
+                f.unlink()
+            except Exception:
+                pass
+
+def load_phash_index():
+    if PHASH_INDEX["entries"] is not None:
+        return
+    entries = []
+    try:
+        if PHASH_INDEX_PATH.exists():
+            entries = json.loads(PHASH_INDEX_PATH.read_text())
+    except Exception as e:
+        logger.warning("Could not read duplicate index: %s", e)
+    PHASH_INDEX["entries"] = entries
+    PHASH_INDEX["hashes"] = np.array([[int(h, 16) for h in e["hashes"]] for e in entries], dtype=np.uint64).reshape(len(entries), 5)
+    PHASH_INDEX["durations"] = np.array([e["duration"] for e in entries], dtype=np.float64)
+
+def find_duplicate(hashes: np.ndarray, duration: float):
+    """Nearest indexed video by mean Hamming distance over the sampled frames, if close enough."""
+    load_phash_index()
+    if not PHASH_INDEX["entries"]:
+        return None
+    xor = PHASH_INDEX["hashes"] ^ hashes.astype(np.uint64)[None, :]
+    distances = np.unpackbits(xor.view(np.uint8), axis=1).reshape(len(xor), -1).sum(axis=1) / len(hashes)
+    # mirrors may trim a few seconds, but not change the runtime much
+    distances[np.abs(PHASH_INDEX["durations"] - duration) > max(5.0, duration * 0.02)] = np.inf
+    best = int(np.argmin(distances))
+    if distances[best] <= PHASH_THRESHOLD:
+        return PHASH_INDEX["entries"][best]
+    return None
+
+async def add_to_phash_index(hashes: np.ndarray, duration: float, sent: Message, name: str):
+    load_phash_index()
+    media = sent.video or sent.document
+    entry = {
+        "hashes": [f"{int(h):016x}" for h in hashes],
+        "duration": duration,
+        "name": name,
+        "file_id": media.file_id if media else None,
+        "chat_id": sent.chat.id,
+        "message_id": sent.id,
+    }
+    PHASH_INDEX["entries"].append(entry)
+    PHASH_INDEX["hashes"] = np.vstack([PHASH_INDEX["hashes"], hashes.astype(np.uint64)[None, :]])
+    PHASH_INDEX["durations"] = np.append(PHASH_INDEX["durations"], duration)
+    data = json.dumps(PHASH_INDEX["entries"]).encode()
+    await asyncio.to_thread(_write_atomic, PHASH_INDEX_PATH, data)
+
+async def check_duplicate(c: Client, m: Message, job: dict, source, duration: float = 0):
+    """Fingerprints `source` and acts on a near-duplicate per the user's /dupcheck mode.
+
+    Returns (handled, fingerprint); handled is True when the upload was skipped or
+    the earlier file_id was re-sent. A fingerprint left in job["fingerprint"] by an
+    earlier check of the same video (e.g. its URL) was already matched, so it is
+    only handed back for indexing the upload.
+    """
+    uid = m.from_user.id
+    mode = job_settings(job)["dupcheck"] or DUPCHECK_DEFAULT
+    if mode == "off":
+        return False, (None, 0)
+    fingerprint = job.pop("fingerprint", None)
+    if fingerprint is not None:
+        return False, fingerprint
+    with trace_span(job, "fingerprint"):
+        fingerprint = await video_fingerprint(source, duration, cancel_event=job["cancel"])
+    hashes, duration = fingerprint
+    if hashes is None:
+        return False, fingerprint
+    match = find_duplicate(hashes, duration)
+    if not match:
+        return False, fingerprint
+    if mode == "reuse" and match.get("file_id"):
+        caption = job_settings(job)["caption"]
+        caption = job_caption(uid, caption, job, match["name"])
+        sent = await c.send_video(chat_id=m.chat.id, video=match["file_id"], caption=caption_for_chat(caption, ""), parse_mode=ParseMode.MARKDOWN)
+        job["sent"].append((sent, caption))
+        job["duplicate_of"] = match["name"]
+        await m.reply_text(f"ডুপ্লিকেট পাওয়া গেছে ({match['name']}), আগের ফাইলটি আপলোড ছাড়াই আবার পাঠানো হয়েছে।")
+        return True, fingerprint
+    if mode in ("skip", "reuse"):
+        job["duplicate_of"] = match["name"]
+        await m.reply_text(f"ডুপ্লিকেট পাওয়া গেছে ({match['name']}), আপলোড বাদ দেওয়া হয়েছে।")
+        return True, fingerprint
+    await m.reply_text(f"⚠️ সম্ভাব্য ডুপ্লিকেট: এটি আগে আপলোড করা \"{match['name']}\" এর মতো দেখাচ্ছে।")
+    return False, fingerprint
+
+async def deliver_job_uploads(c: Client, m: Message, job: dict, sent_before: int = 0):
+    """Copies what this job sent since `sent_before` to its delivery targets.
+
+    The counts add up on the job; its runner reports them once via report_delivery.
+    """
+    targets = job["targets"] if job["targets"] is not None else job_settings(job)["targets"] or []
+    uploaded = job["sent"][sent_before:]
+    if targets and uploaded and not job["cancel"].is_set():
+        await wait_for_turn(job)
+        with trace_span(job, "deliver"):
+            delivered, failed = await deliver_to_targets(c, uploaded, targets)
+        counts = job.setdefault("delivered", {"targets": len(targets), "ok": 0, "failed": 0})
+        counts["ok"] += delivered
+        counts["failed"] += failed
+
+async def report_delivery(m: Message, job: dict):
+    counts = job.get("delivered")
+    if not counts:
+        return
+    try:
+        await m.reply_text(f"{counts['targets']} টি চ্যাটে পাঠানো হয়েছে: সফল {counts['ok']}, ব্যর্থ {counts['failed']}")
+    except Exception as e:
+        logger.warning("Delivery summary failed: %s", e)
+
+async def report_upload_failure(status: StatusMessage, job: dict, text: str):
+    """Leaves the failure as the job's final status; an archive member's failure is only
+    shown and counted, so the remaining members keep reporting in the same message."""
+    if job.get("archive_failures") is not None:
+        job["archive_failures"].append(text)
+        await status.update(text)
+    else:
+        await status.finish(text)
+
+async def process_file_and_upload(c: Client, m: Message, in_path: Path, original_name: str = None, job: dict = None, is_video: bool = None, expand_archives: bool = True):
+    uid = m.from_user.id
+    own_job = job is None
+    if own_job:
+        cancel_event = asyncio.Event()
+        TASKS.setdefault(uid, []).append(cancel_event)
+        job = new_job(uid, "upload", cancel_event=cancel_event)
+    else:
+        # the caller registered this event in TASKS, so Cancel reaches every stage
+        cancel_event = job["cancel"]
+    sent_before = len(job["sent"])
+    # stages report in the caller's status message; whoever created it cleans it up
+    status = job.get("status")
+    own_status = status is None
+    if own_status:
+        status = StatusMessage(c, m, job)
     
     upload_path = in_path
     temp_thumb_path = None
-    final_caption_template = USER_CAPTIONS.get(uid)
+    sheet_path = None
+    settings = job_settings(job)
+    final_caption_template = settings["caption"]
 
     try:
         final_name = original_name or in_path.name
-        is_video = bool(m.video)
-        
-        if is_video:
+        if is_video is None:
+            is_video = bool(m.video)
+
+        kind = archive_kind(in_path, final_name) if expand_archives and not is_video else None
+        if kind:
+            job["archive_failures"] = []
+            try:
+                count = await upload_archive_members(c, m, in_path, kind, job)
+            finally:
+                failed = job.pop("archive_failures")
+            if not cancel_event.is_set():
+                text = f"আর্কাইভ থেকে {count - len(failed)} টি ফাইল আপলোড হয়েছে: {final_name}"
+                if failed:
+                    text += f"\nব্যর্থ {len(failed)} টি, শেষ ত্রুটি: {failed[-1]}"
+                await status.finish(text)
+            return
+
+        use_renditions = is_video and settings["rendition"]
+
+        fingerprint = (None, 0)
+        if is_video and not use_renditions:
+            duplicate, fingerprint = await check_duplicate(c, m, job, in_path)
+            if duplicate:
+                await deliver_job_uploads(c, m, job, sent_before)
+                return
+
+        target = settings["target_size"] if is_video and not use_renditions else None
+        if target and in_path.stat().st_size > target[0]:
+            target_bytes, preset = target
+            await status.update(f"ভিডিওটি {human_size(target_bytes)} এর মধ্যে two-pass এনকোড করা হচ্ছে ({preset}, {ENCODE_THREADS} threads)...")
+            with trace_span(job, "probe"):
+                duration = await probe_duration(str(in_path))
+            if duration > 0:
+                encoded_path = TMP / f"{in_path.stem}_{target_bytes // (1024 * 1024)}MB.mp4"
+                await wait_for_memory(job, "encode")
+                with trace_span(job, "encode", in_path.stat().st_size) as span:
+                    ok, err, speed = await encode_to_target_size(in_path, encoded_path, target_bytes, duration, preset, cancel_event=cancel_event)
+                    span["speed"] = round(speed, 2)
+            else:
+                ok, err = False, "ভিডিওর দৈর্ঘ্য পাওয়া যায়নি"
+            if ok:
+                upload_path = encoded_path
+                done_text = f"এনকোড সম্পন্ন: {human_size(upload_path.stat().st_size)}, গতি {speed:.2f}x realtime\nআপলোড হচ্ছে..."
+            else:
+                done_text = f"এনকোড ব্যর্থ: {err}\nমূল ফাইলটি আপলোড করা হচ্ছে..."
+            await status.update(done_text)
+        elif is_video and not use_renditions:
             if in_path.suffix.lower() not in {".mp4", ".mkv"}:
                 mkv_path = TMP / f"{in_path.stem}.mkv"
-                try:
-                    status_msg = await m.reply_text(f"ভিডিওটি {in_path.suffix} ফরম্যাটে আছে। MKV এ কনভার্ট করা হচ্ছে...", reply_markup=progress_keyboard())
-                except Exception:
-                    status_msg = await m.reply_text(f"ভিডিওটি {in_path.suffix} ফরম্যাটে আছে। MKV এ কনভার্ট করা হচ্ছে...", reply_markup=progress_keyboard())
-                if messages_to_delete:
-                    messages_to_delete.append(status_msg.id)
-                ok, err = await convert_to_mkv(in_path, mkv_path, status_msg)
+                await status.update(f"ভিডিওটি {in_path.suffix} ফরম্যাটে আছে। MKV এ কনভার্ট করা হচ্ছে...")
+                await wait_for_memory(job, "remux")
+                with trace_span(job, "remux", in_path.stat().st_size):
+                    ok, err = await convert_to_mkv(in_path, mkv_path, status, cancel_event=cancel_event)
                 if not ok:
-                    try:
-                        await status_msg.edit(f"কনভার্সন ব্যর্থ: {err}\nমূল ফাইলটি আপলোড করা হচ্ছে...", reply_markup=None)
-                    except Exception:
-                        await m.reply_text(f"কনভার্সন ব্যর্থ: {err}\nমূল ফাইলটি আপলোড করা হচ্ছে...", reply_markup=None)
+                    await status.update(f"কনভার্সন ব্যর্থ: {err}\nমূল ফাইলটি আপলোড করা হচ্ছে...")
                 else:
                     upload_path = mkv_path
         
-        thumb_path = USER_THUMBS.get(uid)
+        # bytes from the thumbnail store, so a /setthumb mid-upload can't touch this job
+        thumb = await job_thumb(job) if is_video else None
         
-        if is_video and not thumb_path:
-            temp_thumb_path = TMP / f"thumb_{uid}_{int(datetime.now().timestamp())}.jpg"
-            thumb_time_sec = USER_THUMB_TIME.get(uid, 1) # Default to 1 second
-            ok = await generate_video_thumbnail(upload_path, temp_thumb_path, timestamp_sec=thumb_time_sec)
-            if ok:
-                thumb_path = str(temp_thumb_path)
-
-        try:
-            status_msg = await m.reply_text("আপলোড শুরু হচ্ছে...", reply_markup=progress_keyboard())
-        except Exception:
-            status_msg = await m.reply_text("আপলোড শুরু হচ্ছে...", reply_markup=progress_keyboard())
-        if messages_to_delete:
-            messages_to_delete.append(status_msg.id)
+        if is_video and (not thumb or settings["contact_sheet"]):
+            stamp = int(datetime.now().timestamp())
+            temp_thumb_path = TMP / f"thumb_{uid}_{stamp}.jpg"
+            if settings["contact_sheet"]:
+                sheet_path = TMP / f"sheet_{uid}_{stamp}.jpg"
+            # None lets the preview engine pick the best frame on its own
+            thumb_time_sec = settings["thumb_time"]
+            await wait_for_memory(job, "thumbnail")
+            with trace_span(job, "thumbnail"):
+                ok = await generate_video_thumbnail(upload_path, temp_thumb_path, timestamp_sec=thumb_time_sec, sheet_path=sheet_path, cancel_event=cancel_event)
+            if ok and not thumb:
+                thumb = str(temp_thumb_path)
 
         if cancel_event.is_set():
-            try:
-                await status_msg.edit("অপারেশন বাতিল করা হয়েছে, আপলোড শুরু করা হয়নি।", reply_markup=None)
-            except Exception:
-                await m.reply_text("অপারেশন বাতিল করা হয়েছে, আপলোড শুরু করা হয়নি।", reply_markup=None)
-            TASKS[uid].remove(cancel_event)
+            await status.finish("অপারেশন বাতিল করা হয়েছে, আপলোড শুরু করা হয়নি।")
             return
-        
-        duration_sec = get_video_duration(upload_path) if upload_path.exists() else 0
-        
-        caption_to_use = final_name
-        if final_caption_template:
-            caption_to_use = process_dynamic_caption(uid, final_caption_template)
+        await status.update("সব কোয়ালিটি তৈরি ও আপলোড শুরু হচ্ছে..." if use_renditions else "আপলোড হচ্ছে...")
 
-        upload_attempts = 3
-        last_exc = None
-        for attempt in range(1, upload_attempts + 1):
-            try:
-                if is_video:
-                    await c.send_video(
-                        chat_id=m.chat.id,
-                        video=str(upload_path),
-                        caption=caption_to_use,
-                        thumb=thumb_path,
-                        duration=duration_sec,
-                        supports_streaming=True,
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-                else:
-                    await c.send_document(
-                        chat_id=m.chat.id,
-                        document=str(upload_path),
-                        file_name=final_name,
-                        caption=caption_to_use,
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-                
-                if messages_to_delete:
+        if use_renditions:
+            last_exc = await upload_renditions(c, m, in_path, final_name, final_caption_template, thumb, cancel_event, job=job)
+        else:
+            with trace_span(job, "probe"):
+                duration_sec = await asyncio.to_thread(get_video_duration, upload_path) if upload_path.exists() else 0
+            
+            caption_to_use = job_caption(uid, final_caption_template, job, final_name)
+
+            if upload_path.exists() and upload_path.stat().st_size > UPLOAD_LIMIT:
+                last_exc = await upload_split_parts(c, m, upload_path, is_video, final_name, caption_to_use, thumb=thumb, cancel_event=cancel_event, job=job)
+            else:
+                sent, last_exc = await upload_with_retries(
+                    c, m, upload_path, is_video, caption_to_use, final_name,
+                    thumb=thumb,
+                    duration_sec=duration_sec,
+                    cancel_event=cancel_event,
+                    job=job
+                )
+                if sent and fingerprint[0] is not None:
                     try:
-                        await c.delete_messages(chat_id=m.chat.id, message_ids=messages_to_delete)
-                    except Exception:
-                        pass
-                
-                last_exc = None
-                break
-            except Exception as e:
-                last_exc = e
-                logger.warning("Upload attempt %s failed: %s", attempt, e)
-                await asyncio.sleep(2 * attempt)
-                if cancel_event.is_set():
-                    if messages_to_delete:
-                        try:
-                            await c.delete_messages(chat_id=m.chat.id, message_ids=messages_to_delete)
-                        except Exception:
-                            pass
-                    break
+                        await add_to_phash_index(fingerprint[0], fingerprint[1], sent, final_name)
+                    except Exception as e:
+                        logger.warning("Could not update duplicate index: %s", e)
+
+
+        await deliver_job_uploads(c, m, job, sent_before)
 
         if last_exc:
-            await m.reply_text(f"আপলোড ব্যর্থ: {last_exc}", reply_markup=None)
+            job["error"] = str(last_exc)
+            await report_upload_failure(status, job, f"আপলোড ব্যর্থ: {last_exc}")
+        elif sheet_path and sheet_path.exists():
+            try:
+                await c.send_photo(chat_id=m.chat.id, photo=str(sheet_path), caption=f"প্রিভিউ: {final_name}")
+            except Exception as e:
+                logger.warning("Contact sheet send failed: %s", e)
     except Exception as e:
-        await m.reply_text(f"আপলোডে ত্রুটি: {e}")
+        job["error"] = str(e)
+        if not cancel_event.is_set():
+            await report_upload_failure(status, job, f"আপলোডে ত্রুটি: {e}")
     finally:
         try:
             if upload_path != in_path and upload_path.exists():
@@ -954,9 +3401,20 @@ async def process_file_and_upload(c: Client, m: Message, in_path: Path, original
                 in_path.unlink()
             if temp_thumb_path and Path(temp_thumb_path).exists():
                 Path(temp_thumb_path).unlink()
-            TASKS[uid].remove(cancel_event)
+            if sheet_path and sheet_path.exists():
+                sheet_path.unlink()
+            FILE_DIGESTS.pop(str(in_path), None)
         except Exception:
             pass
+        if own_status:
+            await status.finish()
+        if own_job:
+            await report_delivery(m, job)
+            finish_job(job)
+            try:
+                TASKS[uid].remove(cancel_event)
+            except Exception:
+                pass
 
 # *** সংশোধিত: ব্রডকাস্ট কমান্ড ***
 @app.on_message(filters.command("broadcast") & filters.private)
@@ -1074,13 +3532,20 @@ async def periodic_cleanup():
             pass
         await asyncio.sleep(3600)
 
+async def main():
+    await app.start()
+    await start_client_pool()
+    asyncio.create_task(periodic_cleanup())
+    if ROLE == "worker":
+        asyncio.create_task(run_worker())
+    elif ROLE == "front":
+        asyncio.create_task(watch_queue_results())
+    await idle()
+    await stop_client_pool()
+    await app.stop()
+
 if __name__ == "__main__":
     print("Bot চালু হচ্ছে... Flask and Ping threads start করা হচ্ছে, তারপর Pyrogram চালু হবে।")
     t = threading.Thread(target=run_flask_and_ping, daemon=True)
     t.start()
-    try:
-        loop = asyncio.get_event_loop()
-        loop.create_task(periodic_cleanup())
-    except RuntimeError:
-        pass
-    app.run()
+    app.run(main())